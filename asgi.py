@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+''' An asyncio (ASGI) server for the journal's read-only pages.
+
+Gunicorn's sync workers spend most of a listing request waiting on
+Postgres, and each one can only wait for one reader at a time. This
+serves the same pages from one event loop per process instead, with
+asyncpg and a connection pool, so a single process can keep hundreds of
+readers in flight:
+
+    pip install asyncpg uvicorn
+    uvicorn asgi:app --workers 4
+
+It uses the Flask app's URL rules, SQL and templates, so the pages are
+the same ones journal.py serves. Only these are handled here:
+
+    /, /page/<n>, /entry/<id>, /feed.xml, /tags, /tag/<name>
+
+Everything else (logging in, editing, attachments, static files) is
+left to the WSGI app; a front-end server routes GET requests for the
+paths above here and everything else to gunicorn. Visitors here are
+always anonymous.
+
+Needs Python 3.5+, unlike the rest of the journal. '''
+
+import os
+import re
+import asyncio
+import datetime
+
+from urllib.parse import parse_qs
+
+import asyncpg
+
+from jinja2 import Environment
+
+from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.routing import RequestRedirect
+
+import journal
+
+from journal import app as flask_app
+
+
+# How many Postgres connections each process keeps. Readers beyond this
+# wait on the pool, not on a whole process.
+flask_app.config['ASYNC_POOL_SIZE'] = int(os.environ.get(
+    'ASYNC_POOL_SIZE', '10'
+))
+
+
+def asyncpg_sql(query):
+
+    ''' Turn a psycopg2-style query (%s placeholders) into asyncpg's ($1, $2...). '''
+
+    # The queries in journal.py only ever use bare %s, never %(name)s.
+    numbers = iter(range(1, query.count('%s') + 1))
+
+    return re.sub('%s', lambda match: '$%d' % next(numbers), query)
+
+
+DB_ENTRIES_PAGE = asyncpg_sql(journal.DB_ENTRIES_PAGE)
+DB_ENTRIES_COUNT = asyncpg_sql(journal.DB_ENTRIES_COUNT)
+DB_SINGLE_ENTRY = asyncpg_sql(journal.DB_SINGLE_ENTRY)
+DB_TAGS_FOR_ENTRIES = asyncpg_sql(journal.DB_TAGS_FOR_ENTRIES)
+DB_TAG_BY_NAME = asyncpg_sql(journal.DB_TAG_BY_NAME)
+DB_TAG_ENTRIES = asyncpg_sql(journal.DB_TAG_ENTRIES)
+DB_TAG_CLOUD = asyncpg_sql(journal.DB_TAG_CLOUD)
+
+ENTRY_KEYS = ('id', 'title', 'text', 'created')
+
+
+def connect_kwargs(dsn):
+
+    ''' Turn the DATABASE setting into arguments for asyncpg. '''
+
+    # Heroku's DATABASE_URL is already a URL asyncpg understands.
+    if '://' in dsn:
+        return {'dsn': dsn}
+
+    # Otherwise it's a libpq "key=value key=value" string.
+    names = {'dbname': 'database'}
+    kwargs = {}
+
+    for part in dsn.split():
+        key, _, value = part.partition('=')
+        kwargs[names.get(key, key)] = value
+
+    if 'port' in kwargs:
+        kwargs['port'] = int(kwargs['port'])
+
+    return kwargs
+
+
+# One pool per process, made on first use (or at lifespan startup) so
+# it belongs to the event loop that will use it.
+_pool = None
+_pool_lock = None
+
+
+async def get_pool():
+
+    global _pool, _pool_lock
+
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+
+    async with _pool_lock:
+        if _pool is None:
+            size = flask_app.config['ASYNC_POOL_SIZE']
+            _pool = await asyncpg.create_pool(
+                min_size=1, max_size=size,
+                **connect_kwargs(flask_app.config['DATABASE']))
+
+    return _pool
+
+
+async def close_pool():
+
+    global _pool
+
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+# Templates.
+# A plain Jinja2 environment over the Flask app's templates and filters.
+# url_for and session are provided per request by render() below.
+templates = Environment(loader=flask_app.jinja_loader,
+                        autoescape=flask_app.select_jinja_autoescape,
+                        bytecode_cache=flask_app.jinja_env.bytecode_cache)
+templates.filters.update(flask_app.jinja_env.filters)
+
+
+def make_url_for(adapter):
+
+    ''' Return a url_for() for templates that builds from Flask's rules. '''
+
+    def url_for(endpoint, **values):
+        external = values.pop('_external', False)
+        return adapter.build(endpoint, values, force_external=external)
+
+    return url_for
+
+
+async def render(adapter, template_name, **context):
+
+    ''' Render a template off the event loop. '''
+
+    context['url_for'] = make_url_for(adapter)
+    context['session'] = {}
+
+    template = templates.get_template(template_name)
+
+    # Rendering waits on Markdown (see journal.bounded_markdown), which
+    # would stall every other reader if it ran on the loop itself.
+    loop = asyncio.get_event_loop()
+
+    return await loop.run_in_executor(None, template.render, context)
+
+
+# Queries. These mirror their namesakes in journal.py.
+
+async def get_entries_page(con, page, per_page):
+
+    rows = await con.fetch(DB_ENTRIES_PAGE, per_page, (page - 1) * per_page)
+
+    return [dict(zip(ENTRY_KEYS, row)) for row in rows]
+
+
+async def count_pages(con, per_page):
+
+    total = await con.fetchval(DB_ENTRIES_COUNT)
+
+    return max(1, (total + per_page - 1) // per_page)
+
+
+async def attach_tags(con, entries):
+
+    rows = await con.fetch(DB_TAGS_FOR_ENTRIES,
+                           [entry['id'] for entry in entries])
+
+    tags = {}
+
+    for entry_id, name in rows:
+        tags.setdefault(entry_id, []).append(name)
+
+    for entry in entries:
+        entry['tags'] = tags.get(entry['id'], [])
+
+    return entries
+
+
+# Views. Each only queries: it returns (content type, template name,
+# template context), or raises NotFound. Rendering happens afterwards,
+# once the connection is back in the pool, so a slow render never
+# holds a connection other readers are waiting for.
+
+async def show_entries(con, args, page):
+
+    per_page = flask_app.config['ENTRIES_PER_PAGE']
+    page_count = await count_pages(con, per_page)
+
+    if page > page_count:
+        raise NotFound()
+
+    entries = await attach_tags(
+        con, await get_entries_page(con, page, per_page))
+
+    return 'text/html; charset=utf-8', 'list_entries.html', dict(
+        entries=entries,
+        default_entry={'title': '', 'text': '', 'tags': []},
+        page=page,
+        page_count=page_count)
+
+
+async def show_entry(con, args, entry_id):
+
+    row = await con.fetchrow(DB_SINGLE_ENTRY, entry_id)
+
+    if row is None:
+        raise NotFound()
+
+    keys = ('id', 'title', 'text', 'created', 'updated', 'version')
+    entry = dict(zip(keys, row))
+
+    await attach_tags(con, [entry])
+
+    return 'text/html; charset=utf-8', 'show_entry.html', dict(entry=entry)
+
+
+async def feed(con, args):
+
+    entries = await get_entries_page(con, 1, flask_app.config['FEED_SIZE'])
+
+    return 'application/atom+xml; charset=utf-8', 'feed.xml', dict(
+        entries=entries)
+
+
+async def tag_entries(con, args, name):
+
+    row = await con.fetchrow(DB_TAG_BY_NAME, name)
+
+    if row is None:
+        raise NotFound()
+
+    tag = dict(zip(('id', 'name', 'entry_count'), row))
+
+    # asyncpg wants a real timestamp where journal.py passes 'infinity'.
+    before = datetime.datetime.max
+    before_id = 0
+
+    if 'before' in args:
+        before = journal.parse_timestamp(args['before'][0])
+
+        if before is None:
+            raise NotFound()
+
+        try:
+            before_id = int(args.get('before_id', ['0'])[0])
+        except ValueError:
+            before_id = 0
+
+    per_page = flask_app.config['ENTRIES_PER_PAGE']
+
+    rows = await con.fetch(DB_TAG_ENTRIES, tag['id'], before, before_id,
+                           per_page + 1)
+
+    entries = [dict(zip(ENTRY_KEYS, row)) for row in rows[:per_page]]
+    await attach_tags(con, entries)
+
+    return 'text/html; charset=utf-8', 'tag_entries.html', dict(
+        tag=tag,
+        entries=entries,
+        has_more=len(rows) > per_page)
+
+
+async def tag_cloud(con, args):
+
+    rows = await con.fetch(DB_TAG_CLOUD, flask_app.config['TAG_CLOUD_SIZE'])
+
+    tags = [dict(zip(('name', 'entry_count'), row)) for row in rows]
+
+    return 'text/html; charset=utf-8', 'tags.html', dict(tags=tags)
+
+
+# Flask endpoint name -> coroutine serving it here.
+VIEWS = {
+    'show_entries': show_entries,
+    'show_entry': show_entry,
+    'feed': feed,
+    'tag_entries': tag_entries,
+    'tag_cloud': tag_cloud,
+}
+
+
+async def send_response(send, status, content_type, body, headers=(),
+                        head=False):
+
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ] + list(headers),
+    })
+
+    # A HEAD response has the headers (and length) of the GET, no body.
+    await send({'type': 'http.response.body',
+                'body': b'' if head else body})
+
+
+async def lifespan(receive, send):
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await get_pool()
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            await close_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+
+    ''' The ASGI application. '''
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] != 'http':
+        return
+
+    headers = dict(scope['headers'])
+    host = headers.get(b'host', b'localhost').decode('latin-1')
+
+    adapter = flask_app.url_map.bind(
+        host, url_scheme=scope.get('scheme', 'http'),
+        script_name=scope.get('root_path') or None)
+
+    try:
+        endpoint, values = adapter.match(scope['path'], method='GET')
+
+        if endpoint not in VIEWS:
+            raise NotFound()
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            raise MethodNotAllowed(['GET', 'HEAD'])
+
+        args = parse_qs(scope['query_string'].decode('latin-1'))
+
+        pool = await get_pool()
+
+        async with pool.acquire() as con:
+            content_type, template_name, context = await VIEWS[endpoint](
+                con, args, **values)
+
+        body = await render(adapter, template_name, **context)
+
+    except RequestRedirect as redirect:
+        # e.g. /page/1 -> /
+        return await send_response(
+            send, 301, 'text/plain', 'Moved',
+            [(b'location', redirect.new_url.encode('latin-1'))])
+
+    except NotFound:
+        return await send_response(send, 404, 'text/plain', 'Not Found')
+
+    except MethodNotAllowed:
+        return await send_response(send, 405, 'text/plain',
+                                   'Method Not Allowed',
+                                   [(b'allow', b'GET, HEAD')])
+
+    await send_response(send, 200, content_type, body,
+                        head=scope['method'] == 'HEAD')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+''' Compare how many concurrent readers the WSGI and ASGI servers handle.
+
+Start both servers against the same database, with the same number of
+worker processes (one per core is the usual choice), e.g. on 4 cores:
+
+    gunicorn -w 4 -b 127.0.0.1:8000 journal:app
+    uvicorn --workers 4 --port 8001 asgi:app
+
+then run:
+
+    python bench_concurrency.py --workers 4 \\
+        http://127.0.0.1:8000/ http://127.0.0.1:8001/
+
+For each level of concurrency, every server gets that many keep-alive
+connections all requesting the URL as fast as they can. The report
+shows connections per worker process alongside throughput and latency,
+which is where the sync workers fall over: past one connection per
+worker, the rest just queue.
+
+Needs Python 3.5+, and nothing outside the standard library. '''
+
+import time
+import asyncio
+import argparse
+
+from urllib.parse import urlsplit
+
+
+async def read_response(reader):
+
+    ''' Read one HTTP/1.1 response. Returns (status, keep_alive). '''
+
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+
+    status = int(lines[0].split()[1])
+    headers = {}
+
+    for line in lines[1:]:
+        if ':' in line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+
+    keep_alive = headers.get('connection', '').lower() != 'close'
+
+    return status, keep_alive
+
+
+async def client(url, deadline, latencies, errors):
+
+    ''' Request url over one connection, again and again, until deadline. '''
+
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or 80
+    path = parts.path or '/'
+
+    if parts.query:
+        path += '?' + parts.query
+
+    request = ('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' %
+               (path, parts.netloc)).encode('latin-1')
+
+    writer = None
+
+    while time.time() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+
+            start = time.time()
+            writer.write(request)
+            status, keep_alive = await read_response(reader)
+            latencies.append(time.time() - start)
+
+            if status != 200:
+                errors.append(status)
+
+            if not keep_alive:
+                writer.close()
+                writer = None
+
+        except (OSError, asyncio.IncompleteReadError, ValueError) as error:
+            errors.append(type(error).__name__)
+
+            if writer is not None:
+                writer.close()
+                writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+def percentile(values, fraction):
+
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_level(url, connections, duration):
+
+    latencies = []
+    errors = []
+    deadline = time.time() + duration
+
+    await asyncio.gather(*[client(url, deadline, latencies, errors)
+                           for _ in range(connections)])
+
+    return latencies, errors
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('urls', nargs='+',
+                        help="One URL per server to compare.")
+    parser.add_argument('--workers', type=int, required=True,
+                        help="Worker processes each server is running.")
+    parser.add_argument('--levels', default='1,4,16,64,256',
+                        help="Comma-separated connection counts to try.")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="Seconds to run each level for.")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(',')]
+
+    print('%-30s %6s %9s %9s %9s %9s %7s' % (
+        'server', 'conns', 'conns/wkr', 'req/s', 'p50 ms', 'p99 ms',
+        'errors'))
+
+    loop = asyncio.get_event_loop()
+
+    for url in args.urls:
+        for connections in levels:
+            latencies, errors = loop.run_until_complete(
+                run_level(url, connections, args.duration))
+
+            print('%-30s %6d %9.1f %9.1f %9.1f %9.1f %7d' % (
+                url, connections, connections / float(args.workers),
+                len(latencies) / args.duration,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                len(errors)))
+
+
+if __name__ == '__main__':
+
+    main()
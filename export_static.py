@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+''' Export the whole journal as static files.
+
+Renders every entry page, every listing page and the feed with the same
+templates the live site uses, so the output can be served straight from
+nginx or a CDN when traffic spikes:
+
+    python export_static.py /srv/journal --base-url http://journal.example
+
+URLs like /entry/3 are written as entry/3/index.html, so the web server
+needs to try "$uri/index.html" (nginx's try_files does this). Attachments
+aren't copied; proxy /attachment/ to the app.
+
+Only entry pages, listing pages and the feed are exported, so the
+exported pages leave out links to anything else (tag pages, entry
+history, logging in).
+
+A manifest in the output directory remembers what each file was made
+from, so the next export only re-renders pages whose entries changed
+(or every page, if the templates or the base URL changed). '''
+
+import os
+import io
+import json
+import shutil
+import filecmp
+import hashlib
+import argparse
+import multiprocessing
+
+from flask import render_template
+
+from journal import app
+from journal import attach_tags
+from journal import get_all_entries
+
+
+MANIFEST_NAME = '.export_manifest.json'
+
+# Set in each render process by init_worker().
+_base_url = 'http://localhost/'
+
+
+def content_hash(value):
+
+    ''' Return a short stable hash of anything JSON can serialize. '''
+
+    # default=str takes care of the datetimes.
+    data = json.dumps(value, default=str, sort_keys=True)
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def templates_hash():
+
+    ''' Return a hash of every file in the templates directory. '''
+
+    digest = hashlib.sha1()
+    root = os.path.join(app.root_path, app.template_folder)
+
+    for directory, dirs, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            # Skip things like .DS_Store; they aren't templates.
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(directory, name)
+            digest.update(os.path.relpath(path, root).encode('utf-8'))
+
+            with io.open(path, 'rb') as template:
+                digest.update(template.read())
+
+    return digest.hexdigest()
+
+
+def plan_pages(entries, per_page, feed_size, render_key=''):
+
+    ''' Return (path, template, context, key) for every page to export.
+
+    The key changes whenever anything the page shows changes. render_key
+    stands for everything outside the entries that goes into every page
+    (the templates, the base URL), and is folded into each key. '''
+
+    entry_keys = dict(
+        (entry['id'], content_hash([render_key, entry['id'],
+                                    entry['title'], entry['text'],
+                                    entry['created'], entry['tags']]))
+        for entry in entries)
+
+    pages = []
+
+    for entry in entries:
+        pages.append((
+            os.path.join('entry', str(entry['id']), 'index.html'),
+            'show_entry.html',
+            {'entry': entry},
+            entry_keys[entry['id']],
+        ))
+
+    page_count = max(1, (len(entries) + per_page - 1) // per_page)
+
+    for page in range(1, page_count + 1):
+        on_page = entries[(page - 1) * per_page:page * per_page]
+
+        if page == 1:
+            path = 'index.html'
+        else:
+            path = os.path.join('page', str(page), 'index.html')
+
+        # The page number links depend on page_count, so it's in the key.
+        key = content_hash([render_key, page, page_count] +
+                           [entry_keys[entry['id']] for entry in on_page])
+
+        pages.append((
+            path,
+            'list_entries.html',
+            {'entries': on_page,
+             'default_entry': {'title': '', 'text': '', 'tags': []},
+             'page': page,
+             'page_count': page_count},
+            key,
+        ))
+
+    in_feed = entries[:feed_size]
+
+    pages.append((
+        'feed.xml',
+        'feed.xml',
+        {'entries': in_feed},
+        content_hash([render_key] +
+                     [entry_keys[entry['id']] for entry in in_feed]),
+    ))
+
+    return pages
+
+
+def init_worker(base_url):
+
+    ''' Set up a render process. '''
+
+    global _base_url
+
+    _base_url = base_url
+
+    # Pool workers aren't allowed pools of their own, and there's no
+    # reader waiting on an export anyway, so render Markdown in-process.
+    app.config['MARKDOWN_PROCESSES'] = 0
+
+
+def render_page(page):
+
+    ''' Render one planned page and return (path, html). Runs in the pool. '''
+
+    path, template, context, key = page
+
+    # A request context is what gives the templates url_for() and an
+    # (anonymous, so no edit links) session. static_export tells the
+    # templates to leave out links to pages that aren't exported (tag
+    # pages, history, logging in).
+    with app.test_request_context('/', base_url=_base_url):
+        html = render_template(template, static_export=True, **context)
+
+    return path, html
+
+
+def write_if_changed(path, html):
+
+    ''' Write html to path unless the file already holds exactly that. '''
+
+    data = html.encode('utf-8')
+
+    if os.path.exists(path):
+        with io.open(path, 'rb') as existing:
+            if existing.read() == data:
+                return False
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Write then rename, so the web server never serves half a file.
+    temp_path = path + '.tmp'
+    with io.open(temp_path, 'wb') as out:
+        out.write(data)
+    os.rename(temp_path, path)
+
+    return True
+
+
+def copy_static(output_dir):
+
+    ''' Copy the static directory into the export, skipping unchanged files. '''
+
+    for root, dirs, files in os.walk(app.static_folder):
+        relative = os.path.relpath(root, app.static_folder)
+        target_dir = os.path.normpath(
+            os.path.join(output_dir, 'static', relative))
+
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        for name in files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_dir, name)
+
+            if (not os.path.exists(target) or
+                    not filecmp.cmp(source, target, shallow=False)):
+                shutil.copy2(source, target)
+
+
+def load_manifest(output_dir):
+
+    try:
+        with io.open(os.path.join(output_dir, MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+
+    data = json.dumps(manifest, sort_keys=True, indent=1)
+
+    with io.open(os.path.join(output_dir, MANIFEST_NAME), 'wb') as out:
+        out.write(data.encode('utf-8'))
+
+
+def export(output_dir, base_url='http://localhost/', jobs=None):
+
+    ''' Export the journal into output_dir.
+
+    Returns the list of paths that were (re)written. '''
+
+    with app.test_request_context('/'):
+        entries = attach_tags(get_all_entries())
+
+    # Editing a template, or moving the site to another URL, changes
+    # every page even though no entry changed.
+    render_key = content_hash([base_url, templates_hash()])
+
+    pages = plan_pages(entries,
+                       app.config['ENTRIES_PER_PAGE'],
+                       app.config['FEED_SIZE'],
+                       render_key)
+
+    old_manifest = load_manifest(output_dir)
+    new_manifest = dict((page[0], page[3]) for page in pages)
+
+    # A page needs rendering if what it's made of changed, or if
+    # someone deleted the file out from under the last export.
+    stale = [page for page in pages
+             if old_manifest.get(page[0]) != page[3] or
+             not os.path.exists(os.path.join(output_dir, page[0]))]
+
+    written = []
+
+    if stale:
+        pool = multiprocessing.Pool(jobs, init_worker, [base_url])
+
+        try:
+            for path, html in pool.imap_unordered(render_page, stale):
+                if write_if_changed(os.path.join(output_dir, path), html):
+                    written.append(path)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    # Deleted entries, and pages that no longer exist because there are
+    # fewer entries, shouldn't linger on the static site.
+    for path in set(old_manifest) - set(new_manifest):
+        try:
+            os.remove(os.path.join(output_dir, path))
+
+        except OSError:
+            pass
+
+    copy_static(output_dir)
+    save_manifest(output_dir, new_manifest)
+
+    return written
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--base-url', default='http://localhost/',
+                        help="Where the export will be served from; "
+                             "used for the absolute links in the feed.")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Render processes (default: one per core).")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    written = export(args.output_dir, args.base_url, args.jobs)
+
+    print("Wrote %d file(s) to %s" % (len(written), args.output_dir))
+
+
+if __name__ == '__main__':
+
+    main()
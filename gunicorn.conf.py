@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+''' Gunicorn settings for the journal.
+
+    gunicorn -c gunicorn.conf.py journal:app
+
+Templates are compiled once in the master, before any workers exist,
+and every worker renders the busiest pages once before it's handed
+real requests. That way the first visitors after a deploy or restart
+don't wait on template compilation and cold caches.
+
+Each worker runs several threads. Besides letting a worker wait on
+Postgres for more than one reader at a time, that's what gives the
+per-process admission limits (ADMISSION_LIMITS in journal.py) something
+to count: a sync worker only ever has one request in flight. On
+Python 2 the threaded worker needs the futures and trollius packages
+(both in requirements.txt). '''
+
+import os
+
+
+worker_class = 'gthread'
+
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+
+def on_starting(server):
+
+    from journal import compile_templates
+
+    compile_templates()
+
+
+def post_worker_init(worker):
+
+    from journal import warm_up
+
+    warm_up()
@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import time
+import difflib
+import math
+import hashlib
+import tempfile
+import mimetypes
 import datetime
+import threading
+import multiprocessing
+import collections
 
 # A library of stuff to use with "with", ie context.
 from contextlib import closing
@@ -13,6 +23,9 @@ from flask import abort
 from flask import request
 from flask import url_for
 from flask import redirect
+from flask import send_file
+from flask import Response
+from flask import jsonify
 
 # for cookie handling: admin
 from flask import session
@@ -27,9 +40,21 @@ from flask import session
 # distinct state or just toss it all in one big box like this...
 from flask import g
 
-# Markdown is a Flask extension that allows us
-# to preserve MarkDown tags in Python output.
-from flaskext.markdown import Markdown
+# Markup marks a string as already-safe HTML so Jinja2 won't escape it.
+from flask import Markup
+
+# Markdown turns entry text into HTML. It used to be hooked up through
+# the Flask-Markdown extension, but that renders inside the worker with
+# no limits, so now it's called directly from a process pool instead.
+import markdown
+
+# Jinja2 can save the Python it compiles each template into, so the
+# next process to need that template loads it instead of compiling it.
+from jinja2 import FileSystemBytecodeCache
+
+# Turns whatever name an uploaded file came with into something that's
+# safe to put in a URL and can't climb out of a directory.
+from werkzeug.utils import secure_filename
 
 '''
 # It turns out that putting tags on stuff that is handed
@@ -44,6 +69,7 @@ from flaskext.markdown import Markdown
 '''
 
 import psycopg2
+import psycopg2.extensions
 
 # pip needs to install and freeze this.
 # Fortunately, I've now completed that.
@@ -52,13 +78,67 @@ from passlib.hash import pbkdf2_sha256
 
 
 DB_SCHEMA = """
+DROP TABLE IF EXISTS entry_tags;
+DROP TABLE IF EXISTS tags;
+DROP FUNCTION IF EXISTS count_entry_tags();
+DROP TABLE IF EXISTS attachments;
+DROP TABLE IF EXISTS entry_revisions;
 DROP TABLE IF EXISTS entries;
 CREATE TABLE entries (
     id serial PRIMARY KEY,
     title VARCHAR (127) NOT NULL,
     text TEXT NOT NULL,
+    created TIMESTAMP NOT NULL,
+    updated TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE entry_revisions (
+    entry_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+    revision INTEGER NOT NULL,
+    title VARCHAR (127) NOT NULL,
+    is_snapshot BOOLEAN NOT NULL,
+    body TEXT NOT NULL,
+    created TIMESTAMP NOT NULL,
+    PRIMARY KEY (entry_id, revision)
+);
+CREATE TABLE attachments (
+    id serial PRIMARY KEY,
+    entry_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+    sha256 CHAR (64) NOT NULL,
+    filename VARCHAR (255) NOT NULL,
+    content_type VARCHAR (127) NOT NULL,
+    size BIGINT NOT NULL,
     created TIMESTAMP NOT NULL
-)
+);
+CREATE INDEX attachments_entry_id ON attachments (entry_id);
+CREATE INDEX attachments_sha256 ON attachments (sha256);
+CREATE TABLE tags (
+    id serial PRIMARY KEY,
+    name VARCHAR (63) NOT NULL UNIQUE,
+    entry_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX tags_entry_count ON tags (entry_count DESC, name);
+CREATE TABLE entry_tags (
+    tag_id INTEGER NOT NULL REFERENCES tags (id) ON DELETE CASCADE,
+    entry_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+    entry_created TIMESTAMP NOT NULL,
+    PRIMARY KEY (tag_id, entry_id)
+);
+CREATE INDEX entry_tags_listing
+    ON entry_tags (tag_id, entry_created DESC, entry_id DESC);
+CREATE INDEX entry_tags_entry_id ON entry_tags (entry_id);
+CREATE FUNCTION count_entry_tags() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE tags SET entry_count = entry_count + 1 WHERE id = NEW.tag_id;
+    ELSE
+        UPDATE tags SET entry_count = entry_count - 1 WHERE id = OLD.tag_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER entry_tags_count AFTER INSERT OR DELETE ON entry_tags
+    FOR EACH ROW EXECUTE PROCEDURE count_entry_tags()
 """
 
 # "Although the %s placeholders in the SQL look like string formatting,
@@ -70,21 +150,140 @@ CREATE TABLE entries (
 
 DB_ENTRY_INSERT = """
 INSERT INTO entries (title, text, created) VALUES (%s, %s, %s)
+RETURNING id
 """
 
 DB_ENTRIES_LIST = """
 SELECT id, title, text, created FROM entries ORDER BY created DESC
 """
 
+# LIMIT/OFFSET is fine for a journal this size, and it means any page
+# number can be linked to (or exported) directly.
+DB_ENTRIES_PAGE = """
+SELECT id, title, text, created FROM entries ORDER BY created DESC
+LIMIT %s OFFSET %s
+"""
+
+DB_ENTRIES_COUNT = """
+SELECT count(*) FROM entries
+"""
+
 DB_SINGLE_ENTRY = """
-SELECT * FROM entries WHERE id = %s
+SELECT id, title, text, created, updated, version FROM entries WHERE id = %s
 """
 
+# Every update bumps the version. If the editor says which version they
+# started from, the update only happens if nobody else got there first;
+# a NULL version means "whatever is there now" (COALESCE matches it).
 DB_UPDATE_ENTRY = """
-UPDATE entries SET title = %s, text = %s WHERE id = %s
+UPDATE entries SET title = %s, text = %s, updated = %s, version = version + 1
+WHERE id = %s AND version = COALESCE(%s, version)
+RETURNING version
+"""
+
+# Locks the row until the transaction ends, so two updates can't both
+# think they're making the same revision.
+DB_ENTRY_FOR_UPDATE = """
+SELECT text FROM entries WHERE id = %s FOR UPDATE
+"""
+
+# A revision's body is either the full text (a snapshot) or a delta
+# against the revision before it. See make_delta().
+DB_REVISION_INSERT = """
+INSERT INTO entry_revisions (entry_id, revision, title, is_snapshot, body, created)
+VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+DB_REVISION_EXISTS = """
+SELECT 1 FROM entry_revisions WHERE entry_id = %s AND revision = %s
+"""
+
+DB_REVISIONS_LIST = """
+SELECT revision, title, is_snapshot, length(body), created
+FROM entry_revisions WHERE entry_id = %s ORDER BY revision DESC
+"""
+
+# Everything needed to rebuild one revision: the nearest snapshot at or
+# before it, and the deltas from there on. Both halves are lookups on
+# the primary key.
+DB_REVISION_CHAIN = """
+SELECT revision, title, is_snapshot, body, created FROM entry_revisions
+WHERE entry_id = %s AND revision <= %s AND revision >= (
+    SELECT max(revision) FROM entry_revisions
+    WHERE entry_id = %s AND revision <= %s AND is_snapshot
+)
+ORDER BY revision
+"""
+
+DB_ATTACHMENT_INSERT = """
+INSERT INTO attachments (entry_id, sha256, filename, content_type, size, created)
+VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+# Identical files share a hash, so any row for it will do.
+DB_ATTACHMENT_TYPE = """
+SELECT content_type FROM attachments WHERE sha256 = %s LIMIT 1
+"""
+
+# Tags. entry_tags copies each entry's created time so a tag's listing
+# can be read, in order, straight off the entry_tags_listing index.
+# tags.entry_count is kept up to date by a trigger on entry_tags (see
+# DB_SCHEMA), so it stays right even when entries are deleted, and the
+# tag cloud never has to count anything.
+DB_TAG_ENSURE = """
+INSERT INTO tags (name) SELECT %s
+WHERE NOT EXISTS (SELECT 1 FROM tags WHERE name = %s)
+"""
+
+DB_ENTRY_TAG_INSERT = """
+INSERT INTO entry_tags (tag_id, entry_id, entry_created)
+SELECT tags.id, entries.id, entries.created FROM tags, entries
+WHERE tags.name = %s AND entries.id = %s
+"""
+
+DB_ENTRY_TAGS_DELETE = """
+DELETE FROM entry_tags WHERE entry_id = %s
+AND tag_id IN (SELECT id FROM tags WHERE name = ANY(%s))
+"""
+
+DB_TAGS_FOR_ENTRIES = """
+SELECT entry_tags.entry_id, tags.name
+FROM entry_tags JOIN tags ON tags.id = entry_tags.tag_id
+WHERE entry_tags.entry_id = ANY(%s)
+ORDER BY tags.name
+"""
+
+DB_TAG_BY_NAME = """
+SELECT id, name, entry_count FROM tags WHERE name = %s
+"""
+
+# Keyset pagination: each page starts strictly after the last entry of
+# the one before, so a deep page costs the same as the first.
+DB_TAG_ENTRIES = """
+SELECT entries.id, entries.title, entries.text, entries.created
+FROM entry_tags JOIN entries ON entries.id = entry_tags.entry_id
+WHERE entry_tags.tag_id = %s
+AND (entry_tags.entry_created, entry_tags.entry_id) < (%s, %s)
+ORDER BY entry_tags.entry_created DESC, entry_tags.entry_id DESC
+LIMIT %s
+"""
+
+DB_TAG_CLOUD = """
+SELECT name, entry_count FROM tags WHERE entry_count > 0
+ORDER BY entry_count DESC, name LIMIT %s
 """
 
 
+class EditConflict(Exception):
+
+    ''' Raised when an entry changed since the editor loaded it. '''
+
+
+class EntryNotFound(Exception):
+
+    ''' Raised when there's no entry with the given id. '''
+
+
 # I still don't know what the significance of __name__ is here.
 # To learn when I have more time!
 app = Flask(__name__)
@@ -125,19 +324,445 @@ app.config['SECRET_KEY'] = os.environ.get(
     'FLASK_SECRET_KEY', 'sooperseekritvaluenooneshouldknow'
 )
 
+# How many entries show up on each listing page, and in the feed.
+app.config['ENTRIES_PER_PAGE'] = int(os.environ.get(
+    'ENTRIES_PER_PAGE', '20'
+))
+
+app.config['FEED_SIZE'] = int(os.environ.get(
+    'FEED_SIZE', '20'
+))
+
+# How many tags make it into the tag cloud.
+app.config['TAG_CLOUD_SIZE'] = int(os.environ.get(
+    'TAG_CLOUD_SIZE', '50'
+))
+
+# Attachments live on disk, named by the SHA-256 of their contents, so
+# the same screenshot uploaded twice is only stored once. Only their
+# metadata goes in the database.
+app.config['ATTACHMENT_DIR'] = os.environ.get(
+    'ATTACHMENT_DIR', os.path.join(app.root_path, 'attachments')
+)
+
+# Flask refuses request bodies bigger than this with a 413.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get(
+    'ATTACHMENT_MAX_BYTES', str(50 * 1024 * 1024)
+))
+
+# Attachment URLs contain the file's hash, so a URL's content can never
+# change and browsers and CDNs may cache it forever.
+ATTACHMENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# The only types a browser is allowed to show inline. Anything else
+# (HTML above all, but also SVG, which can carry script) is sent as a
+# download, so an upload can't run script on the journal's origin.
+ATTACHMENT_INLINE_TYPES = frozenset([
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+])
+
+# How much of a file is held in memory at once while copying it.
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+# Revisions are mostly stored as deltas, with a full copy every this
+# many revisions so rebuilding an old one never replays a long chain.
+app.config['REVISION_SNAPSHOT_INTERVAL'] = int(os.environ.get(
+    'REVISION_SNAPSHOT_INTERVAL', '10'
+))
+
+# "Slow" is relative, so the threshold (in seconds) is configurable.
+# Anything that takes at least this long to execute gets written to
+# the slow-query log as one JSON object per line, which is easy to
+# grep, tail, or load into something that aggregates.
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get(
+    'SLOW_QUERY_THRESHOLD', '0.25'
+))
+
+app.config['SLOW_QUERY_LOG'] = os.environ.get(
+    'SLOW_QUERY_LOG', 'slow_queries.jsonl'
+)
+
+# EXPLAIN ANALYZE actually runs the statement a second time, so it's
+# opt-in, and only done for the first slow occurrence of each query.
+app.config['SLOW_QUERY_EXPLAIN'] = os.environ.get(
+    'SLOW_QUERY_EXPLAIN', ''
+).lower() in ('1', 'true', 'yes')
+
+
+# One giant entry (pasted logs, big code dumps) shouldn't be able to
+# tie up a worker for every reader, so Markdown rendering has limits:
+# entries longer than MARKDOWN_MAX_CHARS aren't rendered at all, and
+# a render that runs past MARKDOWN_TIMEOUT seconds is abandoned.
+# Either way the entry is shown as escaped preformatted text instead.
+app.config['MARKDOWN_MAX_CHARS'] = int(os.environ.get(
+    'MARKDOWN_MAX_CHARS', '100000'
+))
+
+app.config['MARKDOWN_TIMEOUT'] = float(os.environ.get(
+    'MARKDOWN_TIMEOUT', '2.0'
+))
+
+# Renders happen in this many separate processes, so a runaway render
+# can be killed without killing the worker. 0 renders in-process,
+# with no time budget, which is handy for debugging.
+app.config['MARKDOWN_PROCESSES'] = int(os.environ.get(
+    'MARKDOWN_PROCESSES', '2'
+))
+
+# Renders at least this slow (or that fell back to plain text) are
+# reported, one JSON object per line, like the slow-query log.
+app.config['MARKDOWN_REPORT_THRESHOLD'] = float(os.environ.get(
+    'MARKDOWN_REPORT_THRESHOLD', '0.1'
+))
+
+app.config['MARKDOWN_RENDER_LOG'] = os.environ.get(
+    'MARKDOWN_RENDER_LOG', 'markdown_renders.jsonl'
+)
+
+# Where compiled templates are kept between processes. Set it to an
+# empty string to compile in memory only, the way Flask normally does.
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get(
+    'TEMPLATE_CACHE_DIR', os.path.join(app.root_path, '.template_cache')
+)
+
+# Pages a fresh worker renders once before it takes real traffic.
+# See warm_up() and gunicorn.conf.py.
+app.config['WARM_UP_URLS'] = os.environ.get(
+    'WARM_UP_URLS', '/,/login,/feed.xml'
+).split(',')
+
+
+# Admission control. Every request falls into one of these classes, and
+# each class gets (how many of its requests may be in flight at once in
+# this process, how many seconds a request may have queued before it
+# reached us). Anything over either limit is turned away straight
+# away, instead of piling up until gunicorn times the worker out.
+# The in-flight counts are per process, so they only bite with threaded
+# workers; gunicorn.conf.py sets those up.
+def admission_limit(setting, default):
+
+    ''' Read a "max in flight,max seconds queued" setting. '''
+
+    limit, wait = os.environ.get(setting, default).split(',')
+
+    return int(limit), float(wait)
+
+
+app.config['ADMISSION_LIMITS'] = {
+    'cheap': admission_limit('ADMISSION_CHEAP', '64,10'),
+    'render': admission_limit('ADMISSION_RENDER', '8,2'),
+    'write': admission_limit('ADMISSION_WRITE', '4,5'),
+    'login': admission_limit('ADMISSION_LOGIN', '2,2'),
+}
+
+# What turned-away clients are told, in seconds, via Retry-After.
+app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get(
+    'ADMISSION_RETRY_AFTER', '5'
+))
+
+# Anonymous readers who would be turned away get the last copy of the
+# page instead, if it's no older than this many seconds.
+app.config['ADMISSION_STALE_SECONDS'] = int(os.environ.get(
+    'ADMISSION_STALE_SECONDS', '300'
+))
 
-# The Markdown moduleIt needs an instance associated with it.
-# It does not need to be assigned to a variable.
-# The codehilite solution is courtesy of jbbrokaw:
-# https://github.com/jbbrokaw/learning_journal/blob/master/journal.py
-# It turns out codehilite is actually included in MarkDown!
-Markdown(app, extensions=['codehilite'])
+# How many pages to keep copies of for that.
+app.config['ADMISSION_STALE_PAGES'] = int(os.environ.get(
+    'ADMISSION_STALE_PAGES', '100'
+))
+
+
+def template_bytecode_cache():
+
+    ''' Return the bytecode cache for TEMPLATE_CACHE_DIR, or None. '''
+
+    directory = app.config['TEMPLATE_CACHE_DIR']
+
+    if not directory:
+        return None
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+
+        except OSError:
+            # Read-only filesystem, most likely. Compiling in memory
+            # is slower to start but works just the same.
+            return None
+
+    return FileSystemBytecodeCache(directory)
+
+
+# This has to happen before anything touches app.jinja_env (the
+# template_filter decorator below does), because that's when Flask
+# builds the environment out of these options.
+app.jinja_options = dict(Flask.jinja_options,
+                         bytecode_cache=template_bytecode_cache())
+
+
+# Query shapes that have already had their plan captured.
+# Since parameters are passed separately from the SQL, the SQL string
+# itself (with whitespace squashed) is the "shape" of the statement.
+_explained_queries = set()
+
+# Gunicorn may run threaded workers, and two threads appending to the
+# same file at once would interleave their lines.
+_jsonl_lock = threading.Lock()
+
+
+def append_jsonl(path, record):
+
+    ''' Append record to the file at path as one line of JSON. '''
+
+    # default=str takes care of datetimes in the record.
+    line = json.dumps(record, default=str)
+
+    # These logs are for spotting trouble, so failing to write one must
+    # never be the thing that breaks the page. Log it the ordinary way.
+    try:
+        with _jsonl_lock:
+            with open(path, 'a') as log:
+                log.write(line + '\n')
+
+    except (IOError, OSError) as error:
+        app.logger.warning("Could not write to %s (%s): %s",
+                           path, error, line)
+
+
+class SlowQueryCursor(psycopg2.extensions.cursor):
+
+    ''' A cursor that logs statements slower than SLOW_QUERY_THRESHOLD. '''
+
+    def execute(self, query, vars=None):
+
+        start = time.time()
+        result = super(SlowQueryCursor, self).execute(query, vars)
+        duration = time.time() - start
+
+        if duration >= app.config['SLOW_QUERY_THRESHOLD']:
+            log_slow_query(self, query, vars, duration)
+
+        return result
+
+
+def explain_query(con, query, vars):
+
+    ''' Return the EXPLAIN output for query as a list of lines. '''
+
+    # ANALYZE executes the statement for real, which is fine for a
+    # SELECT but would write everything twice for INSERT/UPDATE.
+    # Also, BUFFERS is only allowed alongside ANALYZE.
+    if query.lstrip().upper().startswith('SELECT'):
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    else:
+        prefix = 'EXPLAIN '
+
+    # A plain cursor, so the EXPLAIN itself doesn't get logged as slow.
+    cur = con.cursor(cursor_factory=psycopg2.extensions.cursor)
+
+    # If the EXPLAIN fails it must not take the caller's transaction
+    # down with it, hence the savepoint.
+    cur.execute("SAVEPOINT slow_query_explain")
+
+    try:
+        cur.execute(prefix + query, vars)
+        plan = [row[0] for row in cur.fetchall()]
+
+    except psycopg2.Error as error:
+        cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        plan = ["EXPLAIN failed: %s" % error]
+
+    else:
+        cur.execute("RELEASE SAVEPOINT slow_query_explain")
+
+    return plan
+
+
+def log_slow_query(cur, query, vars, duration):
+
+    ''' Append one slow statement to the SLOW_QUERY_LOG as JSON. '''
+
+    shape = ' '.join(query.split())
+
+    record = {
+        'logged': datetime.datetime.utcnow().isoformat(),
+        'query': shape,
+        'params': vars,
+        'duration_ms': round(duration * 1000, 3),
+        'rows': cur.rowcount,
+    }
+
+    if app.config['SLOW_QUERY_EXPLAIN'] and shape not in _explained_queries:
+        _explained_queries.add(shape)
+        record['plan'] = explain_query(cur.connection, query, vars)
+
+    append_jsonl(app.config['SLOW_QUERY_LOG'], record)
 
 
 def connect_db():
     ''' Return a connection to the configured database. '''
 
-    return psycopg2.connect(app.config['DATABASE'])
+    # Every cursor made from this connection times its statements.
+    return psycopg2.connect(app.config['DATABASE'],
+                            cursor_factory=SlowQueryCursor)
+
+
+# The pool belongs to whichever process made it. Gunicorn forks its
+# workers after importing this module, so each worker notices the pid
+# changed and makes its own pool rather than sharing the parent's.
+_markdown_pool = None
+_markdown_pool_pid = None
+
+# Renders can come from several threads at once (threaded workers, or
+# the asgi.py read path), and only one of them should make the pool.
+_markdown_pool_lock = threading.Lock()
+
+
+def get_markdown_pool():
+
+    ''' Return this process's Markdown rendering pool, making it if needed.
+
+    Call with _markdown_pool_lock held. '''
+
+    global _markdown_pool, _markdown_pool_pid
+
+    if _markdown_pool is None or _markdown_pool_pid != os.getpid():
+        _markdown_pool = multiprocessing.Pool(
+            app.config['MARKDOWN_PROCESSES'])
+        _markdown_pool_pid = os.getpid()
+
+    return _markdown_pool
+
+
+def submit_markdown(text):
+
+    ''' Start rendering text in the pool. Returns (pool, pending result). '''
+
+    # Under the lock, so the pool can't be terminated between our
+    # getting it and handing it the task.
+    with _markdown_pool_lock:
+        pool = get_markdown_pool()
+
+        return pool, pool.apply_async(markdown_to_html, [text])
+
+
+def reset_markdown_pool(pool=None):
+
+    ''' Kill the Markdown pool, including any render stuck inside it.
+
+    Given a pool, only kill it if it's still the current one: renders
+    that timed out waiting on a pool another thread already replaced
+    mustn't take the replacement down with them. '''
+
+    global _markdown_pool
+
+    with _markdown_pool_lock:
+        if pool is not None and pool is not _markdown_pool:
+            return
+
+        if _markdown_pool is not None and _markdown_pool_pid == os.getpid():
+            _markdown_pool.terminate()
+
+        _markdown_pool = None
+
+
+def markdown_to_html(text):
+
+    ''' Render Markdown text to HTML. Runs inside the pool. '''
+
+    # The codehilite solution is courtesy of jbbrokaw:
+    # https://github.com/jbbrokaw/learning_journal/blob/master/journal.py
+    # It turns out codehilite is actually included in MarkDown!
+    return markdown.markdown(text, extensions=['codehilite'])
+
+
+@app.template_filter('bounded_markdown')
+def bounded_markdown(text, entry_id=None):
+
+    ''' Render text as Markdown within the configured size and time limits.
+
+    Falls back to escaped preformatted text when the limits are exceeded. '''
+
+    start = time.time()
+
+    if len(text) > app.config['MARKDOWN_MAX_CHARS']:
+        html = None
+        outcome = 'too_large'
+
+    elif app.config['MARKDOWN_PROCESSES'] <= 0:
+        html = markdown_to_html(text)
+        outcome = 'rendered'
+
+    else:
+        pool, pending = submit_markdown(text)
+
+        try:
+            html = pending.get(app.config['MARKDOWN_TIMEOUT'])
+            outcome = 'rendered'
+
+        except multiprocessing.TimeoutError:
+            # The render is still running in the pool and there's no
+            # way to cancel a single task, so the whole pool goes.
+            reset_markdown_pool(pool)
+            html = None
+            outcome = 'timeout'
+
+    duration = time.time() - start
+
+    if (outcome != 'rendered' or
+            duration >= app.config['MARKDOWN_REPORT_THRESHOLD']):
+        append_jsonl(app.config['MARKDOWN_RENDER_LOG'], {
+            'logged': datetime.datetime.utcnow().isoformat(),
+            'entry_id': entry_id,
+            'chars': len(text),
+            'duration_ms': round(duration * 1000, 3),
+            'outcome': outcome,
+        })
+
+    if html is None:
+        # Markup's % operator escapes the text it's given.
+        return Markup('<pre class="markdown_fallback">%s</pre>') % text
+
+    return Markup(html)
+
+
+def compile_templates():
+
+    ''' Compile every template, filling the bytecode cache.
+
+    Returns the names of the templates. Run this once before forking
+    workers so they all start from an already-compiled cache. '''
+
+    # The templates directory can collect things like .DS_Store.
+    names = list(app.jinja_env.list_templates(extensions=['html', 'xml']))
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return names
+
+
+def warm_up():
+
+    ''' Get this process ready to serve: load every template and render
+    the WARM_UP_URLS once, so the first real visitors aren't the ones
+    paying for it. Returns a dict of URL to HTTP status. '''
+
+    compile_templates()
+
+    client = app.test_client()
+    statuses = {}
+
+    for url in app.config['WARM_UP_URLS']:
+        try:
+            statuses[url] = client.get(url).status_code
+
+        except Exception:
+            # A cold worker is still better than a dead one.
+            app.logger.exception("Warming up %s failed", url)
+            statuses[url] = None
+
+    return statuses
 
 
 def init_db():
@@ -220,176 +845,1072 @@ def teardown_request(exception):
         db.close()
 
 
-def write_entry(title, text):
+# Which admission class each view belongs to. Anything not listed is
+# a 'render'. The login view only counts as 'login' for a POST, since
+# that's when the password hashing happens.
+ADMISSION_CLASSES = {
+    'static': 'cheap',
+    'show_attachment': 'cheap',
+    'logout': 'cheap',
+    'admission_status': 'cheap',
+    'add_entry': 'write',
+    'submit_edit': 'write',
+}
 
-    if not title or not text:
-        raise ValueError(
-            "Title and text are both required for writing an entry.")
+# Everything below is per process and guarded by _admission_lock.
+_admission_lock = threading.Lock()
+_in_flight = collections.defaultdict(int)
+_shed_counts = collections.defaultdict(int)
+_stale_served = collections.defaultdict(int)
 
-    con = get_database_connection()
-    cur = con.cursor()
+# route class -> [requests timed, total seconds queued, longest wait],
+# for requests whose front-end server said when it got them.
+_queue_waits = collections.defaultdict(lambda: [0, 0.0, 0.0])
 
-    # "It is best practice to store time values in UTC."
-    now = datetime.datetime.utcnow()
+# request path -> (time rendered, body, mimetype), oldest first.
+_stale_pages = collections.OrderedDict()
 
-    # Note that the set-as-required-in-psql parameter for
-    # the "created" database field is not supplied to write_entry().
-    # Instead, it's dynamically generated inside this Python and
-    # provided to the database at the time of the HTTP request, making
-    # the resulting journal entry a chimaera of
-    # HTTP, Python, and PSQL.
-    # (not counting the fathomless depths beneath our top level code)
-    cur.execute(DB_ENTRY_INSERT, [title, text, now])
 
+def admission_class():
 
-def get_all_entries():
+    ''' Return the admission class of the current request. '''
 
-    ''' Return a list of all entries as dictionaries. '''
+    if request.endpoint == 'login':
+        return 'login' if request.method == 'POST' else 'cheap'
 
-    con = get_database_connection()
-    cur = con.cursor()
-    cur.execute(DB_ENTRIES_LIST)
+    return ADMISSION_CLASSES.get(request.endpoint, 'render')
 
-    keys = ('id', 'title', 'text', 'created')
 
-    # List comprehension, dictionary compilation, zippitude
-    return [dict(zip(keys, row)) for row in cur.fetchall()]
+def queue_wait():
 
-    # "Get all results with cursor.fetchall().
-    # Get n results with cursor.fetchmany(size=n).
-    # Get one result with cursor.fetchone()."
+    ''' Return how many seconds the request waited before reaching us.
 
+    Only known when the front-end server says when it got the request,
+    in X-Request-Start (Heroku's router sends it; nginx can be told to
+    with "t=${msec}"). Returns None when it doesn't. '''
 
-@app.route('/')
-def show_entries():
+    value = request.headers.get('X-Request-Start', '')
 
-    # When editing, list_entries.html is loaded
-    # with session['editing'] equal to True.
-    # This can create an error where the user
-    # navigates back to the home page without
-    # toggling it back to False, whereupon
-    # add_entry() could be called and failed
-    # repeatedly.
-    # Prevent this case by setting session['editing']
-    # to False every time show_entries is called.
+    if value.startswith('t='):
+        value = value[2:]
 
-    # This tag does not need to exist in submit_edit()
-    # because that function pulls up a redirect
-    # for show_entries().
-    session['editing'] = False
+    try:
+        started = float(value)
 
-    entries = get_all_entries()
-    default_entry = {'title': '', 'text': ''}
+    except ValueError:
+        return None
 
-    # Kwargs shouldn't be named identically to variable names, should they?
-    return render_template('list_entries.html',
-                           entries=entries,
-                           default_entry=default_entry)
+    # Heroku sends milliseconds, nginx sends seconds, others send
+    # microseconds. Nobody's clock is wrong by a factor of a thousand.
+    while started > 1e11:
+        started /= 1000.0
 
+    return max(0.0, time.time() - started)
 
-def get_entry(entry_id):
 
-    ''' Return a single entry from the database. '''
+def is_anonymous_read():
 
-    try:
+    return request.method == 'GET' and not session.get('logged_in')
 
-        con = get_database_connection()
-        cur = con.cursor()
-        cur.execute(DB_SINGLE_ENTRY, [entry_id])
 
-        keys = ('id', 'title', 'text', 'created')
+def shed_request(route_class):
 
-        # Dictionary compilation with zip()
-        return dict(zip(keys, cur.fetchone()))
+    ''' Return the response for a request that isn't being admitted. '''
 
-    except:
+    stale = None
 
-        return "Entry not found"
+    if route_class == 'render' and is_anonymous_read():
+        with _admission_lock:
+            stale = _stale_pages.get(request.full_path)
 
+        if (stale is not None and
+                time.time() - stale[0] > app.config['ADMISSION_STALE_SECONDS']):
+            stale = None
 
-@app.route('/edit/<entry_id>')
-def edit_entry(entry_id):
+    with _admission_lock:
+        if stale is None:
+            _shed_counts[route_class] += 1
+        else:
+            _stale_served[route_class] += 1
 
-    entries = get_all_entries()
-    default_entry = get_entry(entry_id)
+    if stale is not None:
+        response = Response(stale[1], mimetype=stale[2])
+        response.headers['Warning'] = '110 - "Response is Stale"'
 
-    session['editing'] = True
+        return response
 
-    return render_template('list_entries.html',
-                           entries=entries,
-                           default_entry=default_entry)
+    response = Response("The journal is busy right now. Please try again.",
+                        503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
 
+    return response
 
-# This route() requires /<entry_id> in order to receive that from the HTML.
-# Without that, it can't get entry_id as a parameter. I think. From testing...
-# Is this all we need? Submitting an edit takes an ID somehow...
-# but does it take it in the URL or does that come from the HTML?
-@app.route('/submit/<entry_id>', methods=['POST'])
-def submit_edit(entry_id):  # This probably needs an argument. Maybe.
 
-    # This function is the POST part of editing.
-    # GET first, to show edit page
-    # POST second, to submit page edits
-    # (this step is not displayed to the user)
-    # GET third, the return to the entry list
-    # The third step is probably just
-    # return redirect(url_for('show_entries'))
-    # from add_entry(), below. It will be
-    # the return of the POST function, step 2.
+@app.before_request
+def admit_request():
 
-    # EDITING BRANCH note:
-    # submit_edit receives entry_id as a parameter from the edity_entry.html
-    # it also somehow receives entry.title and entry.txt from the form.
+    route_class = admission_class()
+    max_in_flight, max_wait = app.config['ADMISSION_LIMITS'][route_class]
 
-    # If they're not logged in, don't let them change
-    # the database using the console.
-    # ...
-    # This causes huge problems with pytest.
-    # It works perfectly if you don't use pytest.
-    # It has something to do with sessions, encapsulation
-    # of tests, etc.
-    # Leave it commented if you use pytest, uncomment it if not.
-    # if not session['logged_in']:
+    # A request that already waited too long in the queue is likely
+    # to have been given up on by whoever sent it; better to spend the
+    # time on the requests behind it.
+    wait = queue_wait()
+    waited_too_long = wait is not None and wait > max_wait
 
-    #    raise Exception("Attempted to alter database without authorization")
+    with _admission_lock:
+        if wait is not None:
+            waits = _queue_waits[route_class]
+            waits[0] += 1
+            waits[1] += wait
+            waits[2] = max(waits[2], wait)
 
-    # pasted in the try:except block from add_entry()
-    try:
-        # was write_entry()
-        update_entry(request.form['title'], request.form['text'], entry_id)
+        admitted = (not waited_too_long and
+                    _in_flight[route_class] < max_in_flight)
 
-    except psycopg2.Error:
+        if admitted:
+            _in_flight[route_class] += 1
 
-        # This is from Flask: an HTTP error response.
-        abort(500)
+    if not admitted:
+        return shed_request(route_class)
 
-    # Sends you to the show_entries() view.
-    # flask.url_for() sends up the view function named its argument string.
-    return redirect(url_for('show_entries'))
+    g.admission_class = route_class
 
 
-def update_entry(title, text, entry_id):
+@app.after_request
+def remember_page(response):
 
-    if not title or not text or not entry_id:
-        raise ValueError(
-            "Title, text, and entry_id are required for updating an entry.")
+    ''' Keep a copy of successful anonymous renders to serve when shedding. '''
 
-    con = get_database_connection()
-    cur = con.cursor()
-    cur.execute(DB_UPDATE_ENTRY, [title, text, entry_id])
+    if (getattr(g, 'admission_class', None) == 'render' and
+            is_anonymous_read() and
+            response.status_code == 200 and
+            not response.direct_passthrough):
 
+        with _admission_lock:
+            _stale_pages.pop(request.full_path, None)
+            _stale_pages[request.full_path] = (
+                time.time(), response.get_data(), response.mimetype)
 
-# Is this out of order? Should it be above the '/' route due to
-# first full string match search?
-# ... apparently not, it's actually most-complete-string-match, I guess.
-@app.route('/add', methods=['POST'])
-def add_entry():
+            while len(_stale_pages) > app.config['ADMISSION_STALE_PAGES']:
+                _stale_pages.popitem(last=False)
 
-    # If they're not logged in, don't let them change
-    # the database using the console.
-    # ...
-    # This causes huge problems with pytest.
-    # It works perfectly if you don't use pytest.
+    return response
+
+
+@app.teardown_request
+def release_admission(exception):
+
+    # Runs even when the view blew up, so a failure can't leak a slot.
+    route_class = getattr(g, 'admission_class', None)
+
+    if route_class is not None:
+        # g can outlive the request (it belongs to the app context), so
+        # make sure the slot is only ever given back once.
+        g.admission_class = None
+
+        with _admission_lock:
+            _in_flight[route_class] -= 1
+
+
+def admission_stats():
+
+    ''' Return this process's admission counters. '''
+
+    with _admission_lock:
+        return {
+            'pid': os.getpid(),
+            'in_flight': dict(_in_flight),
+            'shed': dict(_shed_counts),
+            'stale_served': dict(_stale_served),
+            'stale_pages': len(_stale_pages),
+            'queue_wait': dict(
+                (route_class, {'count': count,
+                               'total_seconds': total,
+                               'max_seconds': longest})
+                for route_class, (count, total, longest)
+                in _queue_waits.items()),
+        }
+
+
+# Each worker process counts for itself, so this shows whichever worker
+# answered; poll it a few times to see them all.
+@app.route('/admission')
+def admission_status():
+
+    return jsonify(admission_stats())
+
+
+def write_entry(title, text, tags=()):
+
+    if not title or not text:
+        raise ValueError(
+            "Title and text are both required for writing an entry.")
+
+    con = get_database_connection()
+    cur = con.cursor()
+
+    # "It is best practice to store time values in UTC."
+    now = datetime.datetime.utcnow()
+
+    # Note that the set-as-required-in-psql parameter for
+    # the "created" database field is not supplied to write_entry().
+    # Instead, it's dynamically generated inside this Python and
+    # provided to the database at the time of the HTTP request, making
+    # the resulting journal entry a chimaera of
+    # HTTP, Python, and PSQL.
+    # (not counting the fathomless depths beneath our top level code)
+    cur.execute(DB_ENTRY_INSERT, [title, text, now])
+
+    entry_id = cur.fetchone()[0]
+
+    # The first revision is always a snapshot; it has nothing before it.
+    record_revision(cur, entry_id, 1, title, text, None, now)
+
+    if tags:
+        set_entry_tags(entry_id, tags)
+
+    return entry_id
+
+
+def make_delta(old, new):
+
+    ''' Return a compact JSON delta that turns old text into new text.
+
+    The delta is a list of operations on lines of the old text:
+    a positive number copies that many lines, a negative number skips
+    that many, and a string is inserted as-is. Edits usually touch a
+    few lines, so most of a delta is a couple of small numbers. '''
+
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines,
+                                      autojunk=False)
+
+    ops = []
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+
+        if tag == 'equal':
+            ops.append(i2 - i1)
+            continue
+
+        # 'replace' is a delete followed by an insert.
+        if i2 > i1:
+            ops.append(i1 - i2)
+
+        if j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+
+    return json.dumps(ops, separators=(',', ':'))
+
+
+def apply_delta(old, delta):
+
+    ''' Return the text that make_delta(old, <that text>) described. '''
+
+    old_lines = old.splitlines(True)
+    position = 0
+    out = []
+
+    for op in json.loads(delta):
+
+        if isinstance(op, int):
+            if op > 0:
+                out.extend(old_lines[position:position + op])
+            position += abs(op)
+
+        else:
+            out.append(op)
+
+    return ''.join(out)
+
+
+def record_revision(cur, entry_id, revision, title, text, previous_text, now):
+
+    ''' Store revision number revision of an entry. '''
+
+    interval = app.config['REVISION_SNAPSHOT_INTERVAL']
+
+    is_snapshot = previous_text is None or (revision - 1) % interval == 0
+
+    if not is_snapshot:
+        # Entries from before revisions were recorded have no earlier
+        # revision to build a delta on, so they start with a snapshot.
+        cur.execute(DB_REVISION_EXISTS, [entry_id, revision - 1])
+        is_snapshot = cur.fetchone() is None
+
+    if is_snapshot:
+        body = text
+    else:
+        body = make_delta(previous_text, text)
+
+    cur.execute(DB_REVISION_INSERT,
+                [entry_id, revision, title, is_snapshot, body, now])
+
+
+def get_revisions(entry_id):
+
+    ''' Return a summary of every revision of an entry, newest first. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_REVISIONS_LIST, [entry_id])
+
+    keys = ('revision', 'title', 'is_snapshot', 'stored_size', 'created')
+
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def get_revision(entry_id, revision):
+
+    ''' Rebuild one revision of an entry, or return None if there isn't one. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_REVISION_CHAIN, [entry_id, revision, entry_id, revision])
+
+    rows = cur.fetchall()
+
+    if not rows or rows[-1][0] != revision:
+        return None
+
+    # The first row is the snapshot; every row after it is a delta.
+    text = rows[0][3]
+
+    for row in rows[1:]:
+        text = apply_delta(text, row[3])
+
+    return {
+        'entry_id': entry_id,
+        'revision': revision,
+        'title': rows[-1][1],
+        'text': text,
+        'created': rows[-1][4],
+    }
+
+
+def get_all_entries():
+
+    ''' Return a list of all entries as dictionaries. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_ENTRIES_LIST)
+
+    keys = ('id', 'title', 'text', 'created')
+
+    # List comprehension, dictionary compilation, zippitude
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+    # "Get all results with cursor.fetchall().
+    # Get n results with cursor.fetchmany(size=n).
+    # Get one result with cursor.fetchone()."
+
+
+def parse_tags(value):
+
+    ''' Turn a comma-separated string into a sorted list of tag names. '''
+
+    names = set()
+
+    for name in value.split(','):
+        # "Python Tips" and "python-tips " are the same tag. A / would
+        # split the tag's URL in two, so it becomes a - as well.
+        name = '-'.join(name.replace('/', ' ').lower().split())[:63]
+
+        # Browsers read /tag/. and /tag/.. as paths, not tag names.
+        if name.strip('.'):
+            names.add(name)
+
+    return sorted(names)
+
+
+def set_entry_tags(entry_id, tags):
+
+    ''' Make an entry's tags exactly the given names. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+
+    current = set(get_entry_tags([entry_id]).get(entry_id, []))
+    wanted = set(tags)
+
+    for name in sorted(wanted - current):
+
+        # Two posts creating the same new tag at once can both see it
+        # missing; the second then trips the UNIQUE constraint. The
+        # savepoint keeps that from aborting the whole transaction,
+        # and the tag the other post made is just as good.
+        cur.execute("SAVEPOINT tag_ensure")
+
+        try:
+            cur.execute(DB_TAG_ENSURE, [name, name])
+
+        except psycopg2.IntegrityError:
+            cur.execute("ROLLBACK TO SAVEPOINT tag_ensure")
+
+        else:
+            cur.execute("RELEASE SAVEPOINT tag_ensure")
+
+        cur.execute(DB_ENTRY_TAG_INSERT, [name, entry_id])
+
+    removed = sorted(current - wanted)
+
+    if removed:
+        cur.execute(DB_ENTRY_TAGS_DELETE, [entry_id, removed])
+
+
+def get_entry_tags(entry_ids):
+
+    ''' Return a dict of entry id to list of tag names, in one query. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_TAGS_FOR_ENTRIES, [list(entry_ids)])
+
+    tags = {}
+
+    for entry_id, name in cur.fetchall():
+        tags.setdefault(entry_id, []).append(name)
+
+    return tags
+
+
+def attach_tags(entries):
+
+    ''' Give each entry dict a 'tags' list. Returns the entries. '''
+
+    tags = get_entry_tags([entry['id'] for entry in entries])
+
+    for entry in entries:
+        entry['tags'] = tags.get(entry['id'], [])
+
+    return entries
+
+
+def get_tag(name):
+
+    ''' Return a tag as a dictionary, or None if there's no such tag. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_TAG_BY_NAME, [name])
+
+    row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    return dict(zip(('id', 'name', 'entry_count'), row))
+
+
+def get_tag_entries(tag_id, per_page, before=None, before_id=0):
+
+    ''' Return up to per_page entries with a tag, newest first, starting
+    after the entry (created before, id before_id). '''
+
+    if before is None:
+        # Postgres timestamps understand 'infinity', which is after
+        # everything, so the first page needs no query of its own.
+        before = 'infinity'
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_TAG_ENTRIES, [tag_id, before, before_id, per_page])
+
+    keys = ('id', 'title', 'text', 'created')
+
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def get_tag_cloud(size):
+
+    ''' Return the most used tags with their entry counts. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_TAG_CLOUD, [size])
+
+    return [dict(zip(('name', 'entry_count'), row))
+            for row in cur.fetchall()]
+
+
+def parse_timestamp(value):
+
+    ''' Parse a datetime.isoformat() string, or return None. '''
+
+    # isoformat() leaves the microseconds off when there aren't any.
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    return None
+
+
+def get_entries_page(page, per_page):
+
+    ''' Return one page of entries, newest first, as dictionaries. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_ENTRIES_PAGE, [per_page, (page - 1) * per_page])
+
+    keys = ('id', 'title', 'text', 'created')
+
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def count_pages(per_page):
+
+    ''' Return how many listing pages the journal fills (at least one). '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_ENTRIES_COUNT)
+
+    total = cur.fetchone()[0]
+
+    return max(1, int(math.ceil(total / float(per_page))))
+
+
+# The defaults= makes url_for('show_entries', page=1) build plain '/'.
+@app.route('/', defaults={'page': 1})
+@app.route('/page/<int:page>')
+def show_entries(page):
+
+    per_page = app.config['ENTRIES_PER_PAGE']
+    page_count = count_pages(per_page)
+
+    if page > page_count:
+        abort(404)
+
+    entries = attach_tags(get_entries_page(page, per_page))
+    default_entry = {'title': '', 'text': '', 'tags': []}
+
+    # Kwargs shouldn't be named identically to variable names, should they?
+    return render_template('list_entries.html',
+                           entries=entries,
+                           default_entry=default_entry,
+                           page=page,
+                           page_count=page_count)
+
+
+@app.route('/entry/<int:entry_id>')
+def show_entry(entry_id):
+
+    entry = get_entry(entry_id)
+
+    if entry is None:
+        abort(404)
+
+    attach_tags([entry])
+
+    return render_template('show_entry.html', entry=entry)
+
+
+@app.route('/entry/<int:entry_id>/history')
+def entry_history(entry_id):
+
+    entry = get_entry(entry_id)
+
+    if entry is None:
+        abort(404)
+
+    return render_template('entry_history.html',
+                           entry=entry,
+                           revisions=get_revisions(entry_id))
+
+
+@app.route('/entry/<int:entry_id>/history/<int:revision>')
+def show_revision(entry_id, revision):
+
+    entry_revision = get_revision(entry_id, revision)
+
+    if entry_revision is None:
+        abort(404)
+
+    return render_template('show_revision.html', revision=entry_revision)
+
+
+@app.route('/tag/<name>')
+def tag_entries(name):
+
+    tag = get_tag(name)
+
+    if tag is None:
+        abort(404)
+
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', 0, type=int)
+
+    if before is not None:
+        before = parse_timestamp(before)
+
+        if before is None:
+            abort(404)
+
+    per_page = app.config['ENTRIES_PER_PAGE']
+
+    # One extra row says whether there's another page after this one.
+    entries = get_tag_entries(tag['id'], per_page + 1, before, before_id)
+    has_more = len(entries) > per_page
+    entries = attach_tags(entries[:per_page])
+
+    return render_template('tag_entries.html',
+                           tag=tag,
+                           entries=entries,
+                           has_more=has_more)
+
+
+@app.route('/tags')
+def tag_cloud():
+
+    tags = get_tag_cloud(app.config['TAG_CLOUD_SIZE'])
+
+    return render_template('tags.html', tags=tags)
+
+
+@app.route('/feed.xml')
+def feed():
+
+    entries = get_entries_page(1, app.config['FEED_SIZE'])
+
+    response = app.make_response(
+        render_template('feed.xml', entries=entries))
+    response.mimetype = 'application/atom+xml'
+
+    return response
+
+
+def get_entry(entry_id):
+
+    ''' Return a single entry from the database, or None if there isn't one. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_SINGLE_ENTRY, [entry_id])
+
+    row = cur.fetchone()
+
+    if row is None:
+        return None
+
+    keys = ('id', 'title', 'text', 'created', 'updated', 'version')
+
+    # Dictionary compilation with zip()
+    return dict(zip(keys, row))
+
+
+# The edit page only ever loads the one entry being edited, so it
+# costs the same however big the journal gets.
+@app.route('/edit/<int:entry_id>')
+def edit_entry(entry_id):
+
+    entry = get_entry(entry_id)
+
+    if entry is None:
+        abort(404)
+
+    attach_tags([entry])
+
+    return render_template('edit_entry.html', entry=entry, error=None)
+
+
+# This route() requires /<entry_id> in order to receive that from the HTML.
+# Without that, it can't get entry_id as a parameter. I think. From testing...
+# Is this all we need? Submitting an edit takes an ID somehow...
+# but does it take it in the URL or does that come from the HTML?
+@app.route('/submit/<int:entry_id>', methods=['POST'])
+def submit_edit(entry_id):  # This probably needs an argument. Maybe.
+
+    # This function is the POST part of editing.
+    # GET first, to show edit page
+    # POST second, to submit page edits
+    # (this step is not displayed to the user)
+    # GET third, the return to the entry list
+    # The third step is probably just
+    # return redirect(url_for('show_entries'))
+    # from add_entry(), below. It will be
+    # the return of the POST function, step 2.
+
+    # EDITING BRANCH note:
+    # submit_edit receives entry_id as a parameter from the edity_entry.html
+    # it also somehow receives entry.title and entry.txt from the form.
+
+    # If they're not logged in, don't let them change
+    # the database using the console.
+    # ...
+    # This causes huge problems with pytest.
+    # It works perfectly if you don't use pytest.
+    # It has something to do with sessions, encapsulation
+    # of tests, etc.
+    # Leave it commented if you use pytest, uncomment it if not.
+    # if not session['logged_in']:
+
+    #    raise Exception("Attempted to alter database without authorization")
+
+    # The version the edit form was loaded with. Without one (an old
+    # form, or a script posting directly) the edit always wins.
+    version = request.form.get('version', type=int)
+
+    # Likewise, a form without a tags field leaves the tags alone.
+    tags = None
+    if 'tags' in request.form:
+        tags = parse_tags(request.form['tags'])
+
+    # Staged, not stored: they're only kept once the edit is saved.
+    attachments = stage_uploads(request.files.getlist('attachment'))
+
+    # pasted in the try:except block from add_entry()
+    try:
+        # was write_entry()
+        text = with_attachment_links(request.form['text'], attachments)
+        update_entry(request.form['title'], text, entry_id, version, tags)
+        record_attachments(entry_id, attachments)
+        keep_attachments(attachments)
+
+    except EntryNotFound:
+
+        abort(404)
+
+    except EditConflict:
+
+        # Show them what's there now, but keep what they typed so it
+        # isn't lost. Submitting again overwrites the newer version.
+        entry = get_entry(entry_id)
+        entry['title'] = request.form['title']
+        entry['text'] = request.form['text']
+
+        if tags is None:
+            attach_tags([entry])
+        else:
+            entry['tags'] = tags
+
+        error = "Someone else changed this entry while you were editing it."
+
+        # A file input can't be filled back in for them.
+        if attachments:
+            error += " Your attachments weren't saved; attach them again."
+
+        return render_template('edit_entry.html',
+                               entry=entry, error=error), 409
+
+    except psycopg2.Error:
+
+        # This is from Flask: an HTTP error response.
+        abort(500)
+
+    finally:
+        discard_attachments(attachments)
+
+    # Sends you to the show_entries() view.
+    # flask.url_for() sends up the view function named its argument string.
+    return redirect(url_for('show_entries'))
+
+
+def update_entry(title, text, entry_id, version=None, tags=None):
+
+    ''' Update an entry's title and text, and its tags unless tags is None.
+
+    Raises EntryNotFound if there's no such entry. If version is given
+    and the entry is no longer at that version, raises EditConflict and
+    changes nothing. '''
+
+    if not title or not text or not entry_id:
+        raise ValueError(
+            "Title, text, and entry_id are required for updating an entry.")
+
+    con = get_database_connection()
+    cur = con.cursor()
+
+    now = datetime.datetime.utcnow()
+
+    # The text being replaced is what the new revision's delta is
+    # taken against.
+    cur.execute(DB_ENTRY_FOR_UPDATE, [entry_id])
+    row = cur.fetchone()
+
+    if row is None:
+        raise EntryNotFound("No entry with id %s" % entry_id)
+
+    previous_text = row[0]
+
+    cur.execute(DB_UPDATE_ENTRY, [title, text, now, entry_id, version])
+
+    if cur.rowcount == 0:
+
+        # The entry is there (and locked), so it must have moved on to
+        # a newer version than the one being edited.
+        raise EditConflict(
+            "Entry %s is no longer at version %s" % (entry_id, version))
+
+    # Entry versions and revision numbers are one and the same.
+    new_version = cur.fetchone()[0]
+
+    record_revision(cur, entry_id, new_version, title, text,
+                    previous_text, now)
+
+    if tags is not None:
+        set_entry_tags(entry_id, tags)
+
+
+def attachment_path(sha256):
+
+    ''' Return where the file with this hash is (or would be) stored. '''
+
+    # Splitting on the first two characters keeps any one directory
+    # from collecting every file.
+    return os.path.join(app.config['ATTACHMENT_DIR'], sha256[:2], sha256)
+
+
+def stage_attachment(upload):
+
+    ''' Copy an uploaded file to a temporary file in the attachment store.
+
+    Returns a dict of its metadata, including 'temp_path'; see
+    keep_attachments() and discard_attachments() for what happens to it
+    next. The upload is copied a chunk at a time; Werkzeug has already
+    spooled anything big to a temporary file, so a large file is never
+    held in memory whole. '''
+
+    root = app.config['ATTACHMENT_DIR']
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    digest = hashlib.sha256()
+    size = 0
+
+    # The hash isn't known until the end, so write somewhere temporary
+    # on the same filesystem; keep_attachments() renames it into place.
+    handle, temp_path = tempfile.mkstemp(dir=root)
+
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            while True:
+                chunk = upload.stream.read(ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+    except:
+        os.remove(temp_path)
+        raise
+
+    filename = secure_filename(upload.filename) or 'attachment'
+
+    return {
+        'sha256': digest.hexdigest(),
+        'filename': filename,
+        'content_type': (upload.mimetype or
+                         mimetypes.guess_type(filename)[0] or
+                         'application/octet-stream'),
+        'size': size,
+        'temp_path': temp_path,
+    }
+
+
+def stage_uploads(uploads):
+
+    ''' Stage every non-empty upload and return their metadata.
+
+    Only someone logged in may attach files; anyone else gets a 403. '''
+
+    # A file input left blank still submits a part with no filename.
+    uploads = [upload for upload in uploads if upload.filename]
+
+    if uploads and not session.get('logged_in'):
+        abort(403)
+
+    attachments = []
+
+    try:
+        for upload in uploads:
+            attachments.append(stage_attachment(upload))
+
+    except:
+        discard_attachments(attachments)
+        raise
+
+    return attachments
+
+
+def keep_attachments(attachments):
+
+    ''' Move staged attachments into the store, once their entry is saved. '''
+
+    for attachment in attachments:
+        path = attachment_path(attachment['sha256'])
+
+        if os.path.exists(path):
+            # Already have it.
+            os.remove(attachment['temp_path'])
+
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(attachment['temp_path'], path)
+
+
+def discard_attachments(attachments):
+
+    ''' Remove whatever staged attachments weren't kept. '''
+
+    for attachment in attachments:
+        if os.path.exists(attachment['temp_path']):
+            os.remove(attachment['temp_path'])
+
+
+def with_attachment_links(text, attachments):
+
+    ''' Return text with a Markdown link to each attachment appended. '''
+
+    for attachment in attachments:
+        url = url_for('show_attachment',
+                      sha256=attachment['sha256'],
+                      filename=attachment['filename'])
+
+        # Images are shown inline, anything else is just linked.
+        if attachment['content_type'].startswith('image/'):
+            text += u'\n\n![%s](%s)' % (attachment['filename'], url)
+        else:
+            text += u'\n\n[%s](%s)' % (attachment['filename'], url)
+
+    return text
+
+
+def record_attachments(entry_id, attachments):
+
+    ''' Store the metadata of attachments belonging to an entry. '''
+
+    con = get_database_connection()
+    cur = con.cursor()
+
+    now = datetime.datetime.utcnow()
+
+    for attachment in attachments:
+        cur.execute(DB_ATTACHMENT_INSERT, [
+            entry_id, attachment['sha256'], attachment['filename'],
+            attachment['content_type'], attachment['size'], now])
+
+
+def read_file_range(path, start, stop):
+
+    ''' Yield the bytes of a file from start up to stop, a chunk at a time. '''
+
+    with open(path, 'rb') as source:
+        source.seek(start)
+        remaining = stop - start
+
+        while remaining > 0:
+            chunk = source.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# The filename in the URL is only there to make links readable; the
+# hash alone picks the file, and its type comes from what was stored
+# at upload, never from the URL.
+@app.route('/attachment/<sha256>/<filename>')
+def show_attachment(sha256, filename):
+
+    if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+        abort(404)
+
+    path = attachment_path(sha256)
+
+    if not os.path.isfile(path):
+        abort(404)
+
+    con = get_database_connection()
+    cur = con.cursor()
+    cur.execute(DB_ATTACHMENT_TYPE, [sha256])
+    row = cur.fetchone()
+
+    if row is None:
+        abort(404)
+
+    mimetype = row[0]
+    size = os.path.getsize(path)
+
+    byte_range = None
+
+    # Only single ranges (what players and download resumers ask for)
+    # are honoured; for anything fancier, sending the whole file is
+    # also a correct answer.
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % size
+
+            return response
+
+    if byte_range is not None:
+        start, stop = byte_range
+
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+
+        if file_wrapper is not None:
+            # Hand the server the file already positioned at the start
+            # of the range. Gunicorn sendfile()s from the current offset
+            # and stops at Content-Length, so the range never passes
+            # through Python either.
+            source = open(path, 'rb')
+            source.seek(start)
+            body = file_wrapper(source, ATTACHMENT_CHUNK_SIZE)
+
+        else:
+            # No file_wrapper (the dev server, the test client): stream
+            # just the range, a chunk at a time.
+            body = read_file_range(path, start, stop)
+
+        response = Response(body, 206,
+                            mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, size)
+        response.content_length = stop - start
+
+    else:
+        # send_file() hands the open file to the server's
+        # wsgi.file_wrapper, which gunicorn turns into sendfile(), so
+        # the bytes go from disk to socket without passing through
+        # Python. With USE_X_SENDFILE set, the front-end server does it.
+        response = send_file(path, mimetype=mimetype, add_etags=False)
+
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = ATTACHMENT_CACHE_CONTROL
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.set_etag(sha256)
+
+    if mimetype not in ATTACHMENT_INLINE_TYPES:
+        response.headers['Content-Disposition'] = (
+            'attachment; filename="%s"' % (
+                secure_filename(filename) or 'attachment'))
+
+    return response.make_conditional(request)
+
+
+# Is this out of order? Should it be above the '/' route due to
+# first full string match search?
+# ... apparently not, it's actually most-complete-string-match, I guess.
+@app.route('/add', methods=['POST'])
+def add_entry():
+
+    # If they're not logged in, don't let them change
+    # the database using the console.
+    # ...
+    # This causes huge problems with pytest.
+    # It works perfectly if you don't use pytest.
     # It has something to do with sessions, encapsulation
     # of tests, etc.
     # Leave it commented if you use pytest, uncomment it if not.
@@ -397,8 +1918,14 @@ def add_entry():
 
     #    raise Exception("Attempted to alter database without authorization")
 
+    attachments = stage_uploads(request.files.getlist('attachment'))
+
     try:
-        write_entry(request.form['title'], request.form['text'])
+        text = with_attachment_links(request.form['text'], attachments)
+        entry_id = write_entry(request.form['title'], text,
+                               parse_tags(request.form.get('tags', '')))
+        record_attachments(entry_id, attachments)
+        keep_attachments(attachments)
         print(request.form['text'])
 
     except psycopg2.Error:
@@ -406,6 +1933,9 @@ def add_entry():
         # This is from Flask: an HTTP error response.
         abort(500)
 
+    finally:
+        discard_attachments(attachments)
+
     # Sends you to the show_entries() view.
     # flask.url_for() sends up the view function named its argument string.
     return redirect(url_for('show_entries'))
@@ -29,6 +29,11 @@ def clear_db():
         # NOTE: This database must be created manually on the CLI.
         # Done with:
         # createdb test_learning_journal
+        db.cursor().execute("DROP TABLE entry_tags")
+        db.cursor().execute("DROP TABLE tags")
+        db.cursor().execute("DROP FUNCTION count_entry_tags()")
+        db.cursor().execute("DROP TABLE attachments")
+        db.cursor().execute("DROP TABLE entry_revisions")
         db.cursor().execute("DROP TABLE entries")
         db.commit()
 
@@ -392,19 +397,753 @@ def test_logout(db):
     assert response.status_code == 302
 
 
+def test_slow_query_log(req_context, tmpdir, monkeypatch):
 
+    import json
+    from journal import get_all_entries, write_entry
+
+    log_path = tmpdir.join('slow.jsonl')
+
+    # A zero threshold means every statement counts as slow.
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_THRESHOLD', 0)
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_LOG', str(log_path))
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_EXPLAIN', True)
+
+    write_entry("Slow Title", "Slow Text")
+    get_all_entries()
+
+    records = [json.loads(line) for line in log_path.readlines()]
+
+    # write_entry() runs more than one statement (it records the first
+    # revision too), so pick out the ones this test cares about.
+    inserts = [record for record in records
+               if record['query'].startswith('INSERT INTO entries')]
+    selects = [record for record in records
+               if record['query'].startswith('SELECT id, title')]
+
+    assert len(inserts) == 1
+    assert inserts[0]['params'][0] == "Slow Title"
+
+    assert len(selects) == 1
+    # Other tests may have left committed rows behind, so only check
+    # that the count was recorded, not what it was.
+    assert 'rows' in selects[0]
+    assert 'duration_ms' in selects[0]
+    assert 'plan' in selects[0]
+
+
+def test_bounded_markdown_renders():
+
+    from journal import bounded_markdown
+
+    html = bounded_markdown(u'Some *emphasis*', 1)
+
+    assert '<em>emphasis</em>' in html
+
+
+def test_bounded_markdown_too_large(tmpdir, monkeypatch):
+
+    import json
+    from journal import bounded_markdown
+
+    log_path = tmpdir.join('renders.jsonl')
+
+    monkeypatch.setitem(app.config, 'MARKDOWN_MAX_CHARS', 10)
+    monkeypatch.setitem(app.config, 'MARKDOWN_RENDER_LOG', str(log_path))
+
+    html = bounded_markdown(u'<b>far too long</b> for the limit', 7)
+
+    # Too big to render, so it comes back escaped and preformatted.
+    assert html.startswith('<pre class="markdown_fallback">')
+    assert '&lt;b&gt;far too long&lt;/b&gt;' in html
+
+    record = json.loads(log_path.read())
+
+    assert record['entry_id'] == 7
+    assert record['outcome'] == 'too_large'
+
+
+def test_bounded_markdown_timeout(tmpdir, monkeypatch):
+
+    import json
+    import journal
+    from journal import bounded_markdown
+
+    log_path = tmpdir.join('renders.jsonl')
+
+    # No render can come back from another process in zero seconds.
+    monkeypatch.setitem(app.config, 'MARKDOWN_TIMEOUT', 0)
+    monkeypatch.setitem(app.config, 'MARKDOWN_PROCESSES', 1)
+    monkeypatch.setitem(app.config, 'MARKDOWN_RENDER_LOG', str(log_path))
+
+    html = bounded_markdown(u'Some <i>slow</i> *emphasis*', 9)
+
+    assert html.startswith('<pre class="markdown_fallback">')
+    assert '&lt;i&gt;slow&lt;/i&gt;' in html
+
+    # The pool with the runaway render in it was thrown away.
+    assert journal._markdown_pool is None
+
+    record = json.loads(log_path.read())
+
+    assert record['entry_id'] == 9
+    assert record['outcome'] == 'timeout'
+
+
+def test_reset_stale_markdown_pool(monkeypatch):
+
+    import journal
+
+    monkeypatch.setitem(app.config, 'MARKDOWN_PROCESSES', 1)
+
+    try:
+        stale_pool, pending = journal.submit_markdown(u'first')
+        journal.reset_markdown_pool(stale_pool)
+
+        current_pool, pending = journal.submit_markdown(u'*second*')
+
+        # A render that timed out on the old pool leaves the new one be.
+        journal.reset_markdown_pool(stale_pool)
+
+        assert journal._markdown_pool is current_pool
+        assert '<em>second</em>' in pending.get(10)
+
+    finally:
+        journal.reset_markdown_pool()
+
+
+def test_render_log_unwritable(tmpdir, monkeypatch):
+
+    from journal import bounded_markdown
+
+    monkeypatch.setitem(app.config, 'MARKDOWN_MAX_CHARS', 1)
+    # A directory can't be opened for appending.
+    monkeypatch.setitem(app.config, 'MARKDOWN_RENDER_LOG', str(tmpdir))
+
+    html = bounded_markdown(u'still shown', 3)
+
+    assert 'still shown' in html
+
+
+def test_entry_page(with_entry):
+
+    client = app.test_client()
+
+    # The listing links to the entry's own page.
+    listing = client.get('/').data
+    start = listing.index('/entry/')
+    entry_url = listing[start:listing.index('"', start)]
+
+    response = client.get(entry_url)
+
+    assert response.status_code == 200
+    assert with_entry[0] in response.data
+
+
+def test_missing_entry_page(db):
+
+    response = app.test_client().get('/entry/999999')
+
+    assert response.status_code == 404
+
+
+def test_feed(with_entry):
+
+    response = app.test_client().get('/feed.xml')
+
+    assert response.mimetype == 'application/atom+xml'
+    assert with_entry[0] in response.data
+
+
+def test_static_export(with_entry, tmpdir):
+
+    from export_static import export
+
+    output_dir = str(tmpdir)
+
+    written = export(output_dir, jobs=1)
+
+    assert 'index.html' in written
+    assert 'feed.xml' in written
+    assert with_entry[0] in tmpdir.join('index.html').read()
+
+    # Nothing links to pages that the export doesn't have.
+    assert '/tags' not in tmpdir.join('index.html').read()
+    assert '/login' not in tmpdir.join('index.html').read()
+
+    # Nothing changed, so nothing gets rewritten the second time.
+    assert export(output_dir, jobs=1) == []
+
+    # A new base URL changes the feed's absolute links.
+    written = export(output_dir, base_url='http://example.com/', jobs=1)
+
+    assert 'feed.xml' in written
+    assert 'http://example.com/' in tmpdir.join('feed.xml').read()
+
+
+def test_update_entry_version_conflict(req_context):
+
+    from journal import write_entry, update_entry, get_all_entries, get_entry
+    from journal import EditConflict
+
+    write_entry("Versioned Title", "Versioned Text")
+    entry_id = get_all_entries()[0]['id']
+
+    assert get_entry(entry_id)['version'] == 1
+
+    update_entry("First Edit", "First Edit Text", entry_id, 1)
+
+    edited = get_entry(entry_id)
+    assert edited['version'] == 2
+    assert edited['title'] == "First Edit"
+    assert edited['updated'] is not None
+
+    # A second editor who also started from version 1 loses.
+    with pytest.raises(EditConflict):
+        update_entry("Second Edit", "Second Edit Text", entry_id, 1)
+
+    assert get_entry(entry_id)['title'] == "First Edit"
+
+
+def test_get_missing_entry(req_context):
+
+    from journal import get_entry
+
+    assert get_entry(999999) is None
+
+
+def test_edit_page_missing_entry(db):
+
+    response = app.test_client().get('/edit/999999')
+
+    assert response.status_code == 404
+
+
+def test_submit_edit_conflict(with_entry):
+
+    from journal import get_all_entries
+
+    with app.test_request_context('/'):
+        entry_id = get_all_entries()[0]['id']
+
+    edit_data = {
+        'title': u'Stale Title',
+        'text': u'Stale Text',
+        'version': u'0',
+    }
+
+    response = app.test_client().post('/submit/%s' % entry_id,
+                                      data=edit_data)
+
+    assert response.status_code == 409
+    assert 'Stale Text' in response.data
+
+
+def test_submit_edit_missing_field(with_entry):
+
+    from journal import get_all_entries
+
+    with app.test_request_context('/'):
+        entry_id = get_all_entries()[0]['id']
+
+    # A malformed form is a bad request, not a missing entry.
+    response = app.test_client().post('/submit/%s' % entry_id,
+                                      data={'text': u'No title'})
+
+    assert response.status_code == 400
+
+
+def test_submit_edit_missing_entry(db):
+
+    response = app.test_client().post('/submit/999999',
+                                      data={'title': u'T', 'text': u'T'})
+
+    assert response.status_code == 404
+
+
+def test_delta_round_trip():
+
+    from journal import make_delta, apply_delta
+
+    old = u"one\ntwo\nthree\nfour\n"
+    new = u"one\n2\nthree\nfour\nfive"
+
+    delta = make_delta(old, new)
+
+    assert apply_delta(old, delta) == new
+
+    # Unchanged lines are stored as counts, not copies.
+    assert 'three' not in delta
+
+
+def test_revision_history(req_context, monkeypatch):
+
+    from journal import write_entry, update_entry, get_revision, get_revisions
+
+    monkeypatch.setitem(app.config, 'REVISION_SNAPSHOT_INTERVAL', 3)
+
+    texts = [u"line %d\nunchanged\n" % number for number in range(7)]
+
+    entry_id = write_entry("Revised", texts[0])
+
+    for text in texts[1:]:
+        update_entry("Revised", text, entry_id)
+
+    revisions = get_revisions(entry_id)
+
+    assert [rev['revision'] for rev in revisions] == [7, 6, 5, 4, 3, 2, 1]
+
+    # Revisions 1, 4 and 7 are full copies; the rest are deltas.
+    snapshots = [rev['revision'] for rev in revisions if rev['is_snapshot']]
+    assert snapshots == [7, 4, 1]
+
+    for number, text in enumerate(texts, 1):
+        assert get_revision(entry_id, number)['text'] == text
+
+    assert get_revision(entry_id, 8) is None
+
+
+def test_attachment_upload_and_download(db, tmpdir, monkeypatch):
+
+    import io
+    import hashlib
+
+    contents = b'not really a png, but close enough' * 100
+    sha256 = hashlib.sha256(contents).hexdigest()
+
+    monkeypatch.setitem(app.config, 'ATTACHMENT_DIR', str(tmpdir))
+
+    client = app.test_client()
+
+    # Only someone logged in may attach files.
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    try:
+        entry_data = {
+            'title': u'With Attachment',
+            'text': u'See below',
+            'attachment': (io.BytesIO(contents), 'shot.png'),
+        }
+
+        listing = client.post('/add', data=entry_data,
+                              follow_redirects=True).data
+
+        url = '/attachment/%s/shot.png' % sha256
+
+        # Images get shown inline in the entry.
+        assert url in listing
+        assert tmpdir.join(sha256[:2], sha256).check()
+
+        response = client.get(url)
+
+        assert response.status_code == 200
+        assert response.data == contents
+        assert response.mimetype == 'image/png'
+        assert 'Content-Disposition' not in response.headers
+        assert 'immutable' in response.headers['Cache-Control']
+
+        partial = client.get(url, headers={'Range': 'bytes=10-19'})
+
+        assert partial.status_code == 206
+        assert partial.data == contents[10:20]
+        assert partial.headers['Content-Range'] == (
+            'bytes 10-19/%d' % len(contents))
+
+        cached = client.get(url, headers={'If-None-Match': '"%s"' % sha256})
+
+        assert cached.status_code == 304
+
+    finally:
+        with app.test_request_context('/'):
+            con = get_database_connection()
+            con.cursor().execute("DELETE FROM entries")
+            con.commit()
+
+
+def test_attachment_type_ignores_url(db, tmpdir, monkeypatch):
+
+    import io
+    import hashlib
+
+    contents = b'<script>alert("gotcha")</script>'
+    sha256 = hashlib.sha256(contents).hexdigest()
+
+    monkeypatch.setitem(app.config, 'ATTACHMENT_DIR', str(tmpdir))
+
+    client = app.test_client()
+
+    # Only someone logged in may attach files.
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    try:
+        entry_data = {
+            'title': u'Notes',
+            'text': u'Plain text notes',
+            'attachment': (io.BytesIO(contents), 'notes.txt'),
+        }
+
+        client.post('/add', data=entry_data)
+
+        # Asking for it by a .html name mustn't make it HTML.
+        response = client.get('/attachment/%s/evil.html' % sha256)
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert response.headers['Content-Disposition'].startswith(
+            'attachment')
+
+    finally:
+        with app.test_request_context('/'):
+            con = get_database_connection()
+            con.cursor().execute("DELETE FROM entries")
+            con.commit()
+
+
+def test_anonymous_upload_refused(db, tmpdir, monkeypatch):
+
+    import io
+
+    monkeypatch.setitem(app.config, 'ATTACHMENT_DIR', str(tmpdir))
+
+    entry_data = {
+        'title': u'Anonymous',
+        'text': u'Trying to attach',
+        'attachment': (io.BytesIO(b'filler' * 100), 'big.bin'),
+    }
+
+    response = app.test_client().post('/add', data=entry_data)
+
+    assert response.status_code == 403
+    assert tmpdir.listdir() == []
+
+
+def test_conflicting_edit_keeps_no_upload(with_entry, tmpdir, monkeypatch):
+
+    import io
+    from journal import get_all_entries
+
+    with app.test_request_context('/'):
+        entry_id = get_all_entries()[0]['id']
+
+    monkeypatch.setitem(app.config, 'ATTACHMENT_DIR', str(tmpdir))
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    edit_data = {
+        'title': u'Stale Title',
+        'text': u'Stale Text',
+        'version': u'0',
+        'attachment': (io.BytesIO(b'orphan'), 'orphan.txt'),
+    }
+
+    response = client.post('/submit/%s' % entry_id, data=edit_data)
+
+    assert response.status_code == 409
+    assert 'attach them again' in response.data
+
+    # The edit wasn't saved, so neither was the file.
+    assert tmpdir.listdir() == []
+
+
+def test_missing_attachment(db):
+
+    response = app.test_client().get('/attachment/%s/nope.png' % ('0' * 64))
+
+    assert response.status_code == 404
+
+
+def test_parse_tags():
+
+    from journal import parse_tags
+
+    assert parse_tags(u'Python Tips, flask,, python-tips ') == [
+        u'flask', u'python-tips']
+
+    # Tag names end up in URLs, where a / would be a path separator.
+    assert parse_tags(u'client/server') == [u'client-server']
+
+    # Nor can a tag be a relative path of its own.
+    assert parse_tags(u'., .., ...,.net') == [u'.net']
+
+
+def test_tags_and_counts(req_context):
+
+    from journal import write_entry, update_entry, get_tag, get_tag_cloud
+    from journal import get_tag_entries
+
+    first = write_entry("Tagged One", "Text", [u'python', u'flask'])
+    second = write_entry("Tagged Two", "Text", [u'python'])
+
+    assert get_tag(u'python')['entry_count'] == 2
+    assert get_tag(u'flask')['entry_count'] == 1
+
+    update_entry("Tagged One", "Text", first, tags=[u'python', u'sql'])
+
+    assert get_tag(u'flask')['entry_count'] == 0
+    assert get_tag(u'sql')['entry_count'] == 1
+
+    cloud = get_tag_cloud(10)
+    assert cloud[0] == {'name': u'python', 'entry_count': 2}
+    assert u'flask' not in [tag['name'] for tag in cloud]
+
+    # Keyset pagination, one entry at a time, newest first.
+    python = get_tag(u'python')
+    page_one = get_tag_entries(python['id'], 1)
+    assert [entry['id'] for entry in page_one] == [second]
+
+    last = page_one[-1]
+    page_two = get_tag_entries(python['id'], 1, last['created'], last['id'])
+    assert [entry['id'] for entry in page_two] == [first]
+
+    assert get_tag_entries(python['id'], 1, page_two[-1]['created'],
+                           page_two[-1]['id']) == []
+
+
+def test_tag_page(db):
+
+    entry_data = {
+        u'title': u'Tag Page Entry',
+        u'text': u'Tag page text',
+        u'tags': u'Listing Test',
+    }
+
+    client = app.test_client()
+
+    try:
+        client.post('/add', data=entry_data)
+
+        response = client.get('/tag/listing-test')
+
+        assert response.status_code == 200
+        assert 'Tag Page Entry' in response.data
+
+        assert 'listing-test' in client.get('/tags').data
+        assert client.get('/tag/no-such-tag').status_code == 404
+
+    finally:
+        with app.test_request_context('/'):
+            con = get_database_connection()
+            con.cursor().execute("DELETE FROM entries")
+            con.commit()
+
+
+def test_submit_edit_without_tags_field(db):
+
+    from journal import get_all_entries, get_tag
+
+    client = app.test_client()
+
+    try:
+        client.post('/add', data={u'title': u'Kept Tags', u'text': u'Text',
+                                  u'tags': u'keep-me'})
+
+        with app.test_request_context('/'):
+            entry_id = get_all_entries()[0]['id']
+
+        # A script that only knows about title and text.
+        client.post('/submit/%s' % entry_id,
+                    data={u'title': u'Kept Tags', u'text': u'New text'})
+
+        with app.test_request_context('/'):
+            assert get_tag(u'keep-me')['entry_count'] == 1
+
+    finally:
+        with app.test_request_context('/'):
+            con = get_database_connection()
+            con.cursor().execute("DELETE FROM entries")
+            con.commit()
+
+
+def test_asyncpg_placeholders():
+
+    # The ASGI read path is optional, and needs its own driver.
+    pytest.importorskip('asyncpg')
+
+    from asgi import asyncpg_sql
+
+    assert asyncpg_sql("SELECT 1 WHERE a = %s AND b < (%s, %s)") == (
+        "SELECT 1 WHERE a = $1 AND b < ($2, $3)")
+
+
+def test_asyncpg_connect_kwargs():
+
+    pytest.importorskip('asyncpg')
+
+    from asgi import connect_kwargs
+
+    assert connect_kwargs('postgres://u@h/db') == {'dsn': 'postgres://u@h/db'}
+    assert connect_kwargs('dbname=journal user=fried port=5433') == {
+        'database': 'journal', 'user': 'fried', 'port': 5433}
+
+
+def asgi_request(method, path):
+
+    ''' Send one request through the ASGI app; return (status, headers). '''
+
+    # No async syntax here: this file still has to import on Python 2.
+    import asyncio
+    import asgi
+
+    loop = asyncio.new_event_loop()
+    sent = []
+
+    def send(message):
+        sent.append(message)
+        done = loop.create_future()
+        done.set_result(None)
+        return done
+
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(b'host', b'localhost')],
+    }
+
+    try:
+        loop.run_until_complete(asgi.app(scope, None, send))
+    finally:
+        loop.close()
+
+    return sent[0]['status'], dict(sent[0]['headers'])
+
+
+def test_asgi_redirect():
+
+    pytest.importorskip('asyncpg')
+
+    # Page one lives at /, as it does in the WSGI app.
+    status, headers = asgi_request('GET', '/page/1')
+
+    assert status == 301
+    assert headers[b'location'] == b'http://localhost/'
+
+
+def test_asgi_not_found():
+
+    pytest.importorskip('asyncpg')
+
+    # Logging in is a real page, but not one served from here.
+    assert asgi_request('GET', '/login')[0] == 404
+    assert asgi_request('GET', '/no/such/page')[0] == 404
+
+
+def test_asgi_method_not_allowed():
+
+    pytest.importorskip('asyncpg')
+
+    status, headers = asgi_request('POST', '/')
+
+    assert status == 405
+    assert headers[b'allow'] == b'GET, HEAD'
+
+
+def test_compile_templates():
+
+    import os
+    from journal import compile_templates
+
+    names = compile_templates()
+
+    assert 'base.html' in names
+    assert 'list_entries.html' in names
+    assert 'login.html' in names
+
+    # Stray files in the templates directory aren't templates.
+    assert '.DS_Store' not in names
+
+    assert os.listdir(app.config['TEMPLATE_CACHE_DIR'])
+
+
+def test_warm_up(db):
+
+    from journal import warm_up
+
+    statuses = warm_up()
+
+    assert statuses == dict((url, 200) for url in app.config['WARM_UP_URLS'])
+
+
+@pytest.yield_fixture(scope='function')
+def admission_limits(monkeypatch):
+
+    ''' Let a test change ADMISSION_LIMITS, and put them back after. '''
+
+    from journal import _stale_pages
+
+    monkeypatch.setitem(app.config, 'ADMISSION_LIMITS',
+                        dict(app.config['ADMISSION_LIMITS']))
+    _stale_pages.clear()
+
+    yield app.config['ADMISSION_LIMITS']
+
+    _stale_pages.clear()
+
+
+def test_shed_with_retry_after(db, admission_limits):
+
+    from journal import admission_stats
+
+    shed_before = admission_stats()['shed'].get('render', 0)
+
+    admission_limits['render'] = (0, 2.0)
+
+    response = app.test_client().get('/')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(
+        app.config['ADMISSION_RETRY_AFTER'])
+    assert admission_stats()['shed']['render'] == shed_before + 1
+
+    # Other classes are still let in.
+    assert app.test_client().get('/login').status_code == 200
+
+
+def test_shed_serves_stale_page(db, admission_limits):
+
+    client = app.test_client()
+
+    fresh = client.get('/')
+    assert fresh.status_code == 200
+
+    admission_limits['render'] = (0, 2.0)
+
+    stale = client.get('/')
 
+    assert stale.status_code == 200
+    assert stale.data == fresh.data
+    assert 'Stale' in stale.headers['Warning']
 
 
+def test_shed_after_queueing_too_long(db, admission_limits):
 
+    import time
+    from journal import admission_stats
 
+    started = 't=%.3f' % (time.time() - 60)
 
+    response = app.test_client().get(
+        '/', headers={'X-Request-Start': started})
 
+    assert response.status_code == 503
 
+    # The wait is recorded whether or not the request got in.
+    waits = admission_stats()['queue_wait']['render']
 
+    assert waits['count'] >= 1
+    assert waits['max_seconds'] >= 60
 
 
+def test_admission_status(db):
 
+    import json
 
+    response = app.test_client().get('/admission')
 
+    stats = json.loads(response.data)
 
+    assert 'shed' in stats
+    assert 'in_flight' in stats
+    assert 'queue_wait' in stats